@@ -14,6 +14,19 @@ Typical usage example:
 Args:
     -d (--directory): The directory containing the NHSBT file
     -c (--commit): Commit the changes to the database
+    --no-cache: Don't use or save the cached copy of the NHSBT file
+    --bulk-update: Write changed records from a staging table
+    --batch-size: Number of records written to the database at a time
+    --database-url: SQLAlchemy URL of the database, instead of the live server
+    --pool-size: Connections kept in the pool
+    --isolation-level: Transaction isolation level
+    --statement-timeout: Seconds before a statement times out
+    --no-fast-executemany: Turn off fast_executemany on SQL Server
+    --query-workers: Batches of missing records queried at once
+    --query-batch-size: Keys per query for missing records
+    --server-side-checks: Find missing records with an anti-join on the server
+    --audit-format: Formats to write the audit in, any of xlsx, csv, parquet and sqlite
+    --history-file: SQLite file the audit records of every run are added to
 
 Raises:
     ValueError: Number of columns in the NHSBT file isn't as expected
@@ -25,18 +38,14 @@ Returns:
 
 import os
 import warnings
-from typing import Optional
+from typing import Any, Iterable, Optional
 
 import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
-from openpyxl.utils.dataframe import dataframe_to_rows
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 from ukrr_models.nhsbt_models import UKTPatient, UKTTransplant  # type: ignore
 from ukrr_models.rr_models import UKRR_Deleted_Patient  # type: ignore
 
-from nhsbt_import import utils
+from nhsbt_import import audit, database, history, utils
 from nhsbt_import.df_columns import df_columns
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
@@ -46,47 +55,59 @@ log = utils.create_logs(args.directory)
 
 def import_patient(
     index: int,
-    row: pd.Series,
-    output_dfs: dict[str, pd.DataFrame],
-    session: Session,
+    patient: Any,
+    audit_rows: dict[str, list[dict]],
+    new_patients: list[UKTPatient],
+    updated_patients: dict[UKTPatient, int],
+    patient_index: dict[int, list[UKTPatient]],
+    deleted_index: dict[int, list[UKRR_Deleted_Patient]],
 ) -> Optional[str]:
     """
-    Take a patient row and checks to see if the uktssa is present in the database. If not
+    Take a parsed patient and checks to see if the uktssa is present in the patient index,
+    which is prefetched from the database by utils.create_patient_index. If not
     match type is set to new, a row is created in the output file and a new patient is
-    committed to the database. If the patient does exist a comparison is done to see if
+    added to new_patients to be bulk inserted. If the patient does exist a comparison is done to see if
     an update is required. If it is match type is set to update, an entry is added to
     the corresponding output sheet and an update is committed to the database. If
     no update is require match type is set to existing but that is all. If more than
     one entry is found for a patient an error is logged and match type is left as none
-    which will skip any attempt to upload transplant data.
+    which will skip any attempt to upload transplant data. Patients in the deleted
+    index are flagged and skipped in the same way before anything is queued for them.
 
     Args:
         index (int): The row number from the NHSBT file. Used for messaging
-        row (pd.Series): A row relating to a patient from the NHSBT file
-        output_dfs (dict[str, pd.DataFrame]): A dict of dataframes for outputs
-        session (Session): An sqlalch session
+        patient (Any): A row from utils.parse_patients. A UKTPatient is only created
+            from it if the patient is new
+        audit_rows (dict[str, list[dict]]): The audit rows for each output sheet
+        new_patients (list[UKTPatient]): New patients waiting to be inserted
+        updated_patients (dict[UKTPatient, int]): The change masks of existing patients
+            which have been changed
+        patient_index (dict[int, list[UKTPatient]]): Existing patients keyed by uktssa
+        deleted_index (dict[int, list[UKRR_Deleted_Patient]]): Deleted patients keyed
+            by uktssa, prefetched with the patient index
 
     Returns:
         Optional[str]: A match type (New, Update, existing)
     """
     match_type = None
 
-    incoming_patient = utils.create_incoming_patient(index, row)
-    # If len == 1 patient exists, check if update is required
-    if (
-        len(
-            results := (
-                session.query(UKTPatient)
-                .filter_by(uktssa_no=incoming_patient.uktssa_no)
-                .all()
-            )
+    incoming_patient = patient
+    if incoming_patient.uktssa_no in deleted_index:
+        log.warning(
+            "UKT Patient %s has been deleted, skipping row %s",
+            incoming_patient.uktssa_no,
+            index + 1,
         )
-        == 1
-    ):
+        return match_type
+
+    # If len == 1 patient exists, check if update is required
+    results = patient_index.get(incoming_patient.uktssa_no, [])
+    if len(results) == 1:
         log.info("UKT Patient %s found in database", incoming_patient.uktssa_no)
         existing_patient = results[0]
 
-        if utils.compare_patients(incoming_patient, existing_patient):
+        changes = utils.find_patient_changes(incoming_patient, existing_patient)
+        if not changes:
             match_type = "Existing"
             log.info("No Update required")
         else:
@@ -95,29 +116,32 @@ def import_patient(
             match_type = "Update"
 
             match_row = utils.make_patient_match_row(
-                match_type, incoming_patient, existing_patient
+                match_type, incoming_patient, existing_patient, changes
             )
 
-            output_dfs["updated_patients"] = utils.add_df_row(
-                output_dfs["updated_patients"], match_row
-            )
+            audit_rows["updated_patients"].append(match_row)
 
             utils.update_nhsbt_patient(incoming_patient, existing_patient)
+            # A patient repeated in the file has every change written
+            updated_patients[existing_patient] = (
+                updated_patients.get(existing_patient, 0) | changes
+            )
 
     # If len == 0 add patient to DB
     elif len(results) == 0:
         log.info("Adding patient %s", incoming_patient.uktssa_no)
         match_type = "New"
+        incoming_patient = UKTPatient(**patient._asdict())
 
         match_row = utils.make_patient_match_row(
             match_type, incoming_patient, existing_patient=None
         )
 
-        output_dfs["new_patients"] = utils.add_df_row(
-            output_dfs["new_patients"], match_row
-        )
+        audit_rows["new_patients"].append(match_row)
 
-        session.add(incoming_patient)
+        new_patients.append(incoming_patient)
+        # Keep the index in step so a repeated uktssa in the file is seen as existing
+        patient_index[incoming_patient.uktssa_no] = [incoming_patient]
 
     # If len > 1 something is wrong, raise
     else:
@@ -126,108 +150,106 @@ def import_patient(
     return match_type
 
 
-def import_transplants(
-    index: int, row: pd.Series, output_dfs: dict[str, pd.DataFrame], session: Session
-) -> list[str]:
+def import_transplant(
+    index: int,
+    transplant: Any,
+    audit_rows: dict[str, list[dict]],
+    new_transplants: list[UKTTransplant],
+    updated_transplants: dict[UKTTransplant, int],
+    transplant_index: dict[str, list[UKTTransplant]],
+):
     """
-    Loops over a row looking for dates of registration on the transplant list which is the
-    minimum requirement for a transplant entry. Whenever one is found a transplant object
-    is created and as part of that process a registration id is created. This registration id
-    is added to the list which is returned as a product of this function. The database is
-    consulted to find existing transplants which a matching id. If none is found an
-    entry is added with a match type of new to the output and committed to the database.
-    If one is found the two are compared to see if an update is required. If it is, an entry
-    is added to the output and a commit is made to the database. If more than one entry
-    is found in the database an error is logged.
-
-    max_transplants is determined by what is sent in the file and will need to be adjusted
-    if more columns of transplants are sent. Currently the max is 6
+    Takes a parsed transplant and checks the transplant index, prefetched by
+    utils.create_transplant_index, for an existing transplant with a matching
+    registration id. If none is found an entry is added with a match type of new to the
+    output and the transplant is added to new_transplants to be bulk inserted. If one is found the two are
+    compared to see if an update is required. If it is, an entry is added to the output
+    and the existing transplant is updated. If more than one entry is found in the
+    database an error is logged.
 
     Args:
-        row (pd.Series): A row relating to a patient from the NHSBT file
-        output_dfs (dict[str, pd.DataFrame]): A dict of dataframes for outputs
-        session (Session): An sqlalch session
-
-    Returns:
-        list[int]: A list of all the registration IDs for transplants
+        index (int): The row number from the NHSBT file. Used for messaging
+        transplant (Any): A row from utils.parse_transplants. A UKTTransplant is only
+            created from it if the transplant is new
+        audit_rows (dict[str, list[dict]]): The audit rows for each output sheet
+        new_transplants (list[UKTTransplant]): New transplants waiting to be inserted
+        updated_transplants (dict[UKTTransplant, int]): The change masks of existing
+            transplants which have been changed
+        transplant_index (dict[str, list[UKTTransplant]]): Existing transplants keyed
+            by registration id
     """
-
-    ##################
-    max_transplants = 6
-    ##################
-
-    transplant_counter = 1
-    registration_ids = []
-
-    while (
-        transplant_counter <= max_transplants
-        and row[f"uktr_date_on{transplant_counter}"] != ""
-    ):
-        incoming_transplant = utils.create_incoming_transplant(
-            index, row, transplant_counter
-        )
-        registration_ids.append(incoming_transplant.registration_id)
-        # If len == 1 transplant exists, check if update is required
-        results = (
-            session.query(UKTTransplant)
-            .filter_by(registration_id=incoming_transplant.registration_id)
-            .all()
+    incoming_transplant = transplant
+    # If len == 1 transplant exists, check if update is required
+    results = transplant_index.get(incoming_transplant.registration_id, [])
+    if len(results) == 1:
+        log.info(
+            "Registration ID %s found in database",
+            incoming_transplant.registration_id,
         )
-        if len(results) == 1:
-            log.info(
-                "Registration ID %s found in database",
-                incoming_transplant.registration_id,
-            )
-
-            existing_transplant = results[0]
 
-            if utils.compare_transplants(incoming_transplant, existing_transplant):
-                log.info("No Update required")
-            else:
-                log.info("Updating transplant")
+        existing_transplant = results[0]
 
-                match_row = utils.make_transplant_match_row(
-                    "Update", incoming_transplant, existing_transplant
-                )
-
-                output_dfs["updated_transplants"] = utils.add_df_row(
-                    output_dfs["updated_transplants"], match_row
-                )
-
-                utils.update_nhsbt_transplant(incoming_transplant, existing_transplant)
-
-        # If len == 0 add transplant to DB
-        elif len(results) == 0:
-            log.info("Adding transplant %s", incoming_transplant.registration_id)
+        changes = utils.find_transplant_changes(
+            incoming_transplant, existing_transplant
+        )
+        if not changes:
+            log.info("No Update required")
+        else:
+            log.info("Updating transplant")
 
             match_row = utils.make_transplant_match_row(
-                "New", incoming_transplant, existing_transplant=None
+                "Update", incoming_transplant, existing_transplant, changes
             )
 
-            output_dfs["new_transplants"] = utils.add_df_row(
-                output_dfs["new_transplants"], match_row
+            audit_rows["updated_transplants"].append(match_row)
+
+            utils.update_nhsbt_transplant(incoming_transplant, existing_transplant)
+            updated_transplants[existing_transplant] = (
+                updated_transplants.get(existing_transplant, 0) | changes
             )
 
-            session.add(incoming_transplant)
+    # If len == 0 add transplant to DB
+    elif len(results) == 0:
+        log.info("Adding transplant %s", incoming_transplant.registration_id)
+        incoming_transplant = UKTTransplant(**transplant._asdict())
 
-        # If len > 1 something is wrong, raise
-        else:
-            log.error(
-                "%s in the database multiple times", incoming_transplant.registration_id
-            )
-        transplant_counter += 1
+        match_row = utils.make_transplant_match_row(
+            "New", incoming_transplant, existing_transplant=None
+        )
 
-    return registration_ids
+        audit_rows["new_transplants"].append(match_row)
 
+        new_transplants.append(incoming_transplant)
+        transplant_index[incoming_transplant.registration_id] = [incoming_transplant]
 
-def nhsbt_import(input_file_path: str, audit_file_path: str, session: Session):
+    # If len > 1 something is wrong, raise
+    else:
+        log.error(
+            "%s in the database multiple times", incoming_transplant.registration_id
+        )
+
+
+def nhsbt_import(
+    input_file_path: str,
+    audit_file_path: str,
+    session: Session,
+    cache_directory: Optional[str] = None,
+    bulk_update: bool = False,
+    batch_size: int = 1000,
+    query_workers: int = 1,
+    query_batch_size: int = 1000,
+    server_side_checks: bool = False,
+    audit_formats: Iterable[str] = ("xlsx",),
+    session_factory: Optional[sessionmaker] = None,
+) -> dict[str, pd.DataFrame]:
     # THIS IS NOW BREAKING PYLINT BECAUSE IT'S TOO LONG
     """
-    Reads in the NHSBT file and builds all the output dataframes. Uses import_patients()
-    and import_transplants to import the data to the database and build the out puts. Runs
+    Reads in the NHSBT file, or its cached copy, and builds all the output dataframes.
+    Uses import_patient() and import_transplant() to import the data to the database
+    and build the out puts. Runs
     check on all patients and transplants to make sure nothing is missing from the file that
-    was previously included and checks against the deleted patients table to make sure no
-    patients have been deleted in error.
+    was previously included, before anything is written to the database. Patients in the deleted patients table are looked up with
+    the existing patients and aren't imported, so they can't be added again in error.
 
     Expected number of columns will need to be adjusted if NHSBT change the shape of their.
     If we get more or less an error is raised.
@@ -236,151 +258,187 @@ def nhsbt_import(input_file_path: str, audit_file_path: str, session: Session):
         input_file_path (str): NHSBT file path
         audit_file_path (str): Output file path
         session (Session): An sqlalch session
+        cache_directory (Optional[str], optional): Where to keep the cached copy of
+            the NHSBT file. Defaults to None, which turns caching off.
+        bulk_update (bool, optional): Write changed records with one UPDATE per set of
+            changed columns from a staging table rather than with executemany.
+            Defaults to False.
+        batch_size (int, optional): Records written to the database per
+            executemany. Defaults to 1000.
+        query_workers (int, optional): Batches of missing records
+            queried at once, see utils.batch_query. Defaults to 1.
+        query_batch_size (int, optional): Keys per query for missing records.
+            Defaults to 1000.
+        server_side_checks (bool, optional): Find missing patients and transplants
+            with an anti-join on the server, see database.missing_records, rather
+            than fetching every key. Defaults to False.
+        audit_formats (Iterable[str], optional): Formats to write the audit in, see
+            audit.write_audit. Defaults to ("xlsx",).
+        session_factory (Optional[sessionmaker], optional): The factory the session
+            came from, used for the sessions of the query workers. Defaults to None,
+            which queries with the session alone.
 
     Raises:
         ValueError: Number of columns in the NHSBT file isn't as expected
+
+    Returns:
+        dict[str, pd.DataFrame]: The output dataframes written to the audit
     """
 
     ###################################
     expected_number_of_columns = 125
     ###################################
 
-    nhsbt_df = pd.read_csv(
-        input_file_path,
-        na_filter=False,
-        skip_blank_lines=True,
+    # The transplants of every row are formatted so they can be cached. Only those of
+    # the imported patients are used.
+    patients, transplants = utils.parse_nhsbt_file(
+        input_file_path, expected_number_of_columns, cache_directory
+    )
+    file_uktssas = patients["uktssa_no"].tolist()
+
+    audit_rows = utils.create_audit_rows(df_columns)
+    deleted_index: dict[int, list[UKRR_Deleted_Patient]] = {}
+    patient_index = utils.create_patient_index(session, file_uktssas, deleted_index)
+    # Deleted patients are flagged up front so nothing is written for them
+    audit_rows["deleted_patients"].extend(
+        utils.make_deleted_patient_row("Deleted", deleted_patient)
+        for deleted_patients in deleted_index.values()
+        for deleted_patient in deleted_patients
     )
-    utils.column_is_int(nhsbt_df, "UKTR_ID")
-
-    nhsbt_number_of_columns = nhsbt_df.shape[1]
-
-    if expected_number_of_columns != nhsbt_number_of_columns:
-        raise ValueError(
-            f"""
-            Expected {expected_number_of_columns} columns in the NHSBT file
-            There are {nhsbt_number_of_columns}
-            """
-        )
 
-    output_dfs = utils.create_output_dfs(df_columns)
-    registration_ids = []
+    imported_rows = []
+    new_patients: list[UKTPatient] = []
+    new_transplants: list[UKTTransplant] = []
+    updated_patients: dict[UKTPatient, int] = {}
+    updated_transplants: dict[UKTTransplant, int] = {}
 
-    for index, row in nhsbt_df.iterrows():
-        index += 1  # type: ignore [operator]
+    for index, patient in zip(
+        patients.index, patients.itertuples(index=False, name="IncomingPatient")
+    ):
         log.info("on line %s", index + 1)
-        if import_patient(index, row, output_dfs, session):
-            registration_ids.extend(import_transplants(index, row, output_dfs, session))
-
-    file_uktssas = nhsbt_df["UKTR_ID"].tolist()
-
-    if missing_uktssa := utils.check_missing_patients(session, file_uktssas):
-        missing_patients = batch_query(
-            missing_uktssa, session, UKTPatient, UKTPatient.uktssa_no
-        )
-
-        patient_data = pd.DataFrame(
-            [
-                utils.make_missing_patient_row("Missing", missing_patient)
-                for missing_patient in missing_patients
-            ]
-        )
-
-        output_dfs["missing_patients"] = pd.concat(
-            [output_dfs["missing_patients"], patient_data], axis=0, ignore_index=True
-        )  # type: ignore [operator]
-
-    if missing_transplants_ids := utils.check_missing_transplants(
-        session, registration_ids
+        if import_patient(
+            index,
+            patient,
+            audit_rows,
+            new_patients,
+            updated_patients,
+            patient_index,
+            deleted_index,
+        ):
+            imported_rows.append(index)
+
+    transplants = transplants.loc[transplants.index.isin(imported_rows)]
+    registration_ids = transplants["registration_id"].tolist()
+    transplant_index = utils.create_transplant_index(session, registration_ids)
+
+    for index, transplant in zip(
+        transplants.index,
+        transplants.itertuples(index=False, name="IncomingTransplant"),
     ):
-        missing_transplants = batch_query(
-            missing_transplants_ids,
-            session,
-            UKTTransplant,
-            UKTTransplant.registration_id,
-        )
-
-        transplant_dataframe = pd.DataFrame(
-            [
-                utils.make_missing_transplant_match_row(missing_transplant)
-                for missing_transplant in missing_transplants
-            ]
+        import_transplant(
+            index,
+            transplant,
+            audit_rows,
+            new_transplants,
+            updated_transplants,
+            transplant_index,
         )
 
-        output_dfs["missing_transplants"] = pd.concat(
-            [output_dfs["missing_transplants"], transplant_dataframe],
-            axis=0,
-            ignore_index=True,
+    # Missing records are looked up before anything is written. The query workers
+    # use their own connections, which would wait on the locks held by the writes.
+    # The writes only touch records in the file, so the missing ones aren't changed.
+    if server_side_checks:
+        audit_rows["missing_patients"].extend(
+            utils.make_missing_patient_row("Missing", missing_patient)
+            for missing_patient in database.missing_records(
+                session,
+                UKTPatient,
+                UKTPatient.uktssa_no,
+                file_uktssas,
+                query_batch_size,
+            )
         )
-
-    if deleted_uktssa := utils.deleted_patient_check(session, file_uktssas):
-        deleted_patients = batch_query(
-            deleted_uktssa,
-            session,
-            UKRR_Deleted_Patient,
-            UKRR_Deleted_Patient.uktssa_no,
+        audit_rows["missing_transplants"].extend(
+            utils.make_missing_transplant_match_row(missing_transplant)
+            for missing_transplant in database.missing_records(
+                session,
+                UKTTransplant,
+                UKTTransplant.registration_id,
+                registration_ids,
+                query_batch_size,
+            )
+            # Deleted patients are already flagged, so their transplants aren't
+            if missing_transplant.uktssa_no not in deleted_index
         )
 
-        deleted_data = pd.DataFrame(
-            utils.make_deleted_patient_row("Deleted", deleted_patient)
-            for deleted_patient in deleted_patients
-        )
+    else:
+        if missing_uktssa := utils.check_missing_patients(session, file_uktssas):
+            missing_patients = utils.batch_query(
+                missing_uktssa,
+                session,
+                UKTPatient,
+                UKTPatient.uktssa_no,
+                query_batch_size,
+                query_workers,
+                session_factory,
+            )
 
-        output_dfs["deleted_patients"] = pd.concat(
-            [output_dfs["deleted_patients"], deleted_data], axis=0, ignore_index=True
-        )
+            audit_rows["missing_patients"].extend(
+                utils.make_missing_patient_row("Missing", missing_patient)
+                for missing_patient in missing_patients
+            )
 
-    wb = Workbook()
-    wb.remove(wb["Sheet"])
-
-    for sheet_name, df in output_dfs.items():
-        if df.empty:
-            continue
-        ws = wb.create_sheet(sheet_name)
-        for r in dataframe_to_rows(df, index=False, header=True):
-            ws.append(r)
-
-        for i, col in enumerate(df.columns):
-            column = get_column_letter(i + 1)
-            header_length = len(col)
-            cell_length = max(
-                df[col].astype(str).map(len).astype(int).max(), header_length
+        if missing_transplants_ids := utils.check_missing_transplants(
+            session, registration_ids
+        ):
+            missing_transplants = utils.batch_query(
+                missing_transplants_ids,
+                session,
+                UKTTransplant,
+                UKTTransplant.registration_id,
+                query_batch_size,
+                query_workers,
+                session_factory,
             )
-            adjusted_width = int(cell_length) + 2
-            ws.column_dimensions[column].width = adjusted_width
 
-        for row in ws:
-            for cell in row:
-                cell.alignment = Alignment(horizontal="center")
+            audit_rows["missing_transplants"].extend(
+                utils.make_missing_transplant_match_row(missing_transplant)
+                for missing_transplant in missing_transplants
+                if missing_transplant.uktssa_no not in deleted_index
+            )
 
-    if len(wb.sheetnames) == 0:
-        log.info("Nothing to write to audit file")
-    else:
-        if "updated_patients" in wb.sheetnames:
-            utils.colour_differences(wb, "updated_patients")
-        if "updated_transplants" in wb.sheetnames:
-            utils.colour_differences(wb, "updated_transplants")
-        wb.save(audit_file_path)
+    update = database.bulk_update if bulk_update else database.update_changes
+    # Records are written at the end, in batches of batch_size, so repeats later in
+    # the file are included. The writes are Core statements, which don't autoflush,
+    # and the updated records are expunged first so they are never flushed one at a
+    # time.
+    database.bulk_insert(session, UKTPatient, new_patients, batch_size)
+    update(session, UKTPatient, updated_patients, utils.PATIENT_FIELDS, batch_size)
+    database.bulk_insert(session, UKTTransplant, new_transplants, batch_size)
+    update(
+        session,
+        UKTTransplant,
+        updated_transplants,
+        utils.TRANSPLANT_FIELDS,
+        batch_size,
+    )
 
+    output_dfs = utils.create_output_dfs(df_columns, audit_rows)
 
-def batch_query(keys, session, query, key_filter):
-    """
-    Batch query function
-    Args:
-        keys: list of values to filter for
-        session: sqlachemy session
-        query: sqlachemy orm to query
-        key_filter: sqlachemy orm column to filter on
+    audit.write_audit(
+        output_dfs,
+        audit_file_path,
+        audit_formats,
+        {
+            sheet_name: audit.difference_mask(
+                output_dfs[sheet_name],
+                [row[utils.CHANGED_COLUMNS] for row in audit_rows[sheet_name]],
+            )
+            for sheet_name in ("updated_patients", "updated_transplants")
+        },
+    )
 
-    Returns:
-        results: list of query results
-    """
-    results = []
-    batch_size = 1000
-    for i in range(0, len(keys), batch_size):
-        batch = keys[i : i + batch_size]
-        batch_results = session.query(query).filter(key_filter.in_(batch)).all()
-        results.extend(batch_results)
-    return results
+    return output_dfs
 
 
 def main():
@@ -392,13 +450,37 @@ def main():
     """
     input_file_path = utils.get_input_file_path(args.directory)
     audit_file_path = os.path.join(args.directory, "audit.xlsx")
-    utils.clean_csv(input_file_path)
-    session = utils.create_session()
-    nhsbt_import(input_file_path, audit_file_path, session)
+    session_factory = utils.create_session_factory(
+        args.database_url,
+        args.pool_size,
+        args.isolation_level,
+        args.statement_timeout,
+        not args.no_fast_executemany,
+    )
+    session = session_factory()
+    cache_directory = None if args.no_cache else os.path.join(args.directory, "cache")
+    output_dfs = nhsbt_import(
+        input_file_path,
+        audit_file_path,
+        session,
+        cache_directory,
+        args.bulk_update,
+        args.batch_size,
+        args.query_workers,
+        args.query_batch_size,
+        args.server_side_checks,
+        args.audit_format,
+        session_factory,
+    )
     if args.commit:
         session.commit()
     session.close()
 
+    if args.history_file:
+        history.append_history(
+            args.history_file, output_dfs, input_file_path, args.commit
+        )
+
 
 if __name__ == "__main__":
     main()
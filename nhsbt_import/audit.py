@@ -0,0 +1,440 @@
+"""
+This module contains the functions used by the nhsbt_import.py script to write the
+audit file. As well as the excel file the audit can be written to CSV, Parquet or
+SQLite, the sinks in AUDIT_SINKS, chosen with --audit-format.
+
+Functions:
+    difference_mask(df, changed_columns): Finds the NHSBT and RR cells of a sheet to highlight
+    write_audit(output_dfs, audit_file_path, audit_formats, highlights): Writes the output dataframes with each chosen sink
+    write_audit_file(output_dfs, audit_file_path, highlights): Writes the output dataframes to an excel file
+    write_csv_files(output_dfs, audit_path): Writes each output dataframe to a CSV file in the audit directory
+    write_parquet_files(output_dfs, audit_path): Writes each output dataframe to a Parquet file in the audit directory
+    write_sqlite(output_dfs, audit_path): Writes each output dataframe to a table of an SQLite database
+"""
+
+import datetime
+import logging
+import os
+from itertools import repeat
+from typing import Any, Callable, Iterable, Optional
+
+import pandas as pd
+import xlsxwriter  # type: ignore
+from sqlalchemy import create_engine
+
+log = logging.getLogger(__name__)
+
+HIGHLIGHT_COLOUR = "#ADD8E6"
+DATETIME_FORMAT = "yyyy-mm-dd h:mm:ss"
+DATE_FORMAT = "yyyy-mm-dd"
+SOURCES = ("NHSBT", "RR")
+# Excel's limit of 1,048,576 rows per sheet, less the header
+MAX_SHEET_ROWS = 1_048_575
+MANIFEST_SHEET = "manifest"
+# Rows are converted for writing this many at a time
+CHUNK_ROWS = 10_000
+
+
+def difference_mask(
+    df: pd.DataFrame, changed_columns: Optional[list[list[str]]] = None
+) -> pd.DataFrame:
+    """
+    Finds the cells of a sheet to highlight. Each "<label> - NHSBT" column is paired
+    with its "<label> - RR" column, as laid out in df_columns, and both cells are
+    highlighted where the row differs. If the changed columns of each row are
+    supplied, from the change mask of the update, those labels are highlighted.
+    Otherwise the text of the two columns is compared. Each pair is compared a column
+    at a time rather than a row at a time.
+
+    Args:
+        df (pd.DataFrame): An output dataframe
+        changed_columns (Optional[list[list[str]]], optional): The labels of the
+            changed columns of each row, as listed by utils.changed_labels. Defaults
+            to None.
+
+    Returns:
+        pd.DataFrame: True for each cell to highlight
+    """
+    mask = pd.DataFrame(False, index=df.index, columns=df.columns)
+    if changed_columns is not None:
+        changed = pd.Series(changed_columns, index=df.index, dtype=object).explode()
+
+    for label, nhsbt_column, rr_column in _paired_columns(df.columns):
+        if changed_columns is None:
+            differs = (_as_text(df[nhsbt_column]) != _as_text(df[rr_column])).to_numpy()
+        else:
+            differs = df.index.isin(changed.index[changed == label])
+        mask[nhsbt_column] = differs
+        mask[rr_column] = differs
+
+    return mask
+
+
+def write_audit(
+    output_dfs: dict[str, pd.DataFrame],
+    audit_file_path: str,
+    audit_formats: Iterable[str] = ("xlsx",),
+    highlights: Optional[dict[str, pd.DataFrame]] = None,
+) -> bool:
+    """
+    Writes the output dataframes with each of the chosen sinks. The file
+    names of every sink are taken from the audit file path without its extension,
+    e.g. audit.xlsx, audit/new_patients.csv, audit/new_patients.parquet and
+    audit.sqlite. The CSV and Parquet files are kept in their own directory so they
+    aren't mistaken for the NHSBT file by the next run. Only the excel file is
+    highlighted. Every sink replaces all of its output from an earlier run in the
+    same directory, even when there is nothing to write, so no stale sheets are
+    left behind.
+
+    Args:
+        output_dfs (dict[str, pd.DataFrame]): The output dataframes keyed by sheet
+        audit_file_path (str): Excel output file path
+        audit_formats (Iterable[str], optional): Keys of AUDIT_SINKS to write.
+            Defaults to ("xlsx",).
+        highlights (Optional[dict[str, pd.DataFrame]], optional): The cells to
+            highlight, keyed by sheet, as found by difference_mask. Defaults to None.
+
+    Raises:
+        ValueError: An audit format isn't in AUDIT_SINKS
+
+    Returns:
+        bool: True if anything was written, False if there was nothing to write
+    """
+    audit_formats = list(audit_formats)
+    for audit_format in audit_formats:
+        if audit_format not in AUDIT_SINKS:
+            raise ValueError(f"{audit_format} is not an audit format")
+
+    written = _has_rows(output_dfs)
+    if not written:
+        log.info("Nothing to write to audit file")
+
+    audit_path = os.path.splitext(audit_file_path)[0]
+    for audit_format in audit_formats:
+        log.info("Writing %s audit", audit_format)
+        AUDIT_SINKS[audit_format](output_dfs, audit_path, highlights)
+    return written
+
+
+def write_audit_file(
+    output_dfs: dict[str, pd.DataFrame],
+    audit_file_path: str,
+    highlights: Optional[dict[str, pd.DataFrame]] = None,
+    max_rows: int = MAX_SHEET_ROWS,
+) -> bool:
+    """
+    Writes each non empty output dataframe to a sheet of the audit file. The file is
+    written with xlsxwriter in constant_memory mode, so each row is flushed to disk
+    as it is written rather than the whole workbook being held in memory. Column
+    widths and formats are set once per column and the highlighted cells are given
+    a light blue format as they are written.
+
+    A sheet with more rows than fit in an excel sheet is split into numbered parts,
+    e.g. new_transplants_1, new_transplants_2, and a manifest sheet listing the rows
+    of the original sheet in each part is added at the front.
+
+    Args:
+        output_dfs (dict[str, pd.DataFrame]): The output dataframes keyed by sheet
+        audit_file_path (str): Output file path
+        highlights (Optional[dict[str, pd.DataFrame]], optional): The cells to
+            highlight, keyed by sheet, as found by difference_mask. Defaults to None.
+        max_rows (int, optional): The most rows, not counting the header, written
+            to one sheet. Defaults to MAX_SHEET_ROWS.
+
+    Returns:
+        bool: True if the file was written, False if there was nothing to write
+    """
+    output_dfs = {name: df for name, df in output_dfs.items() if not df.empty}
+    if not output_dfs:
+        log.info("Nothing to write to audit file")
+        return False
+
+    highlights = highlights or {}
+    parts = {
+        sheet_name: _sheet_parts(sheet_name, len(df), max_rows)
+        for sheet_name, df in output_dfs.items()
+    }
+    workbook = xlsxwriter.Workbook(
+        audit_file_path,
+        {
+            "constant_memory": True,
+            "strings_to_formulas": False,
+            "strings_to_urls": False,
+        },
+    )
+    formats = _Formats(workbook)
+
+    if any(len(sheet_parts) > 1 for sheet_parts in parts.values()):
+        manifest = _manifest(parts)
+        _write_sheet(workbook.add_worksheet(MANIFEST_SHEET), manifest, None, formats)
+
+    for sheet_name, df in output_dfs.items():
+        mask = highlights.get(sheet_name)
+        for part_name, start, stop in parts[sheet_name]:
+            if len(parts[sheet_name]) > 1:
+                log.info(
+                    "Writing rows %s to %s of %s to %s",
+                    start + 1,
+                    stop,
+                    sheet_name,
+                    part_name,
+                )
+            _write_sheet(
+                workbook.add_worksheet(part_name),
+                df.iloc[start:stop],
+                None if mask is None else mask.iloc[start:stop],
+                formats,
+            )
+
+    workbook.close()
+    return True
+
+
+def write_csv_files(
+    output_dfs: dict[str, pd.DataFrame],
+    audit_path: str,
+    highlights: Optional[dict[str, pd.DataFrame]] = None,
+) -> bool:
+    """
+    Writes each output dataframe to <audit_path>/<sheet>.csv, appending a chunk of
+    rows at a time. Empty dataframes are written as just a header, so a file from an
+    earlier run is always replaced. The directory is created if it doesn't exist.
+
+    Args:
+        output_dfs (dict[str, pd.DataFrame]): The output dataframes keyed by sheet
+        audit_path (str): Output file path without an extension
+        highlights (Optional[dict[str, pd.DataFrame]], optional): Not used by CSV.
+            Defaults to None.
+
+    Returns:
+        bool: True if any rows were written, False if every dataframe was empty
+    """
+    os.makedirs(audit_path, exist_ok=True)
+    for sheet_name, df in output_dfs.items():
+        csv_file_path = os.path.join(audit_path, f"{sheet_name}.csv")
+        for chunk_start in range(0, max(len(df), 1), CHUNK_ROWS):
+            df.iloc[chunk_start : chunk_start + CHUNK_ROWS].to_csv(
+                csv_file_path,
+                mode="w" if chunk_start == 0 else "a",
+                header=chunk_start == 0,
+                index=False,
+            )
+    return _has_rows(output_dfs)
+
+
+def write_parquet_files(
+    output_dfs: dict[str, pd.DataFrame],
+    audit_path: str,
+    highlights: Optional[dict[str, pd.DataFrame]] = None,
+) -> bool:
+    """
+    Writes each output dataframe to <audit_path>/<sheet>.parquet. Empty dataframes
+    are written without any rows, so a file from an earlier run is always replaced.
+    The directory is created if it doesn't exist. Needs pyarrow or fastparquet to be
+    installed. Columns holding more than one type of
+    value, such as numbers and text, are written as text.
+
+    Args:
+        output_dfs (dict[str, pd.DataFrame]): The output dataframes keyed by sheet
+        audit_path (str): Output file path without an extension
+        highlights (Optional[dict[str, pd.DataFrame]], optional): Not used by
+            Parquet. Defaults to None.
+
+    Raises:
+        ImportError: Neither pyarrow nor fastparquet is installed
+
+    Returns:
+        bool: True if any rows were written, False if every dataframe was empty
+    """
+    os.makedirs(audit_path, exist_ok=True)
+    for sheet_name, df in output_dfs.items():
+        _columnar(df).to_parquet(
+            os.path.join(audit_path, f"{sheet_name}.parquet"), index=False
+        )
+    return _has_rows(output_dfs)
+
+
+def write_sqlite(
+    output_dfs: dict[str, pd.DataFrame],
+    audit_path: str,
+    highlights: Optional[dict[str, pd.DataFrame]] = None,
+) -> bool:
+    """
+    Writes each output dataframe to a table named after its sheet in
+    <audit_path>.sqlite, inserting a chunk of rows at a time. The file is recreated
+    on each run and empty dataframes are written as empty tables.
+
+    Args:
+        output_dfs (dict[str, pd.DataFrame]): The output dataframes keyed by sheet
+        audit_path (str): Output file path without an extension
+        highlights (Optional[dict[str, pd.DataFrame]], optional): Not used by
+            SQLite. Defaults to None.
+
+    Returns:
+        bool: True if any rows were written, False if every dataframe was empty
+    """
+    sqlite_file_path = f"{audit_path}.sqlite"
+    if os.path.exists(sqlite_file_path):
+        os.remove(sqlite_file_path)
+
+    engine = create_engine(f"sqlite:///{sqlite_file_path}")
+    try:
+        with engine.begin() as connection:
+            for sheet_name, df in output_dfs.items():
+                df.to_sql(
+                    sheet_name,
+                    connection,
+                    if_exists="replace",
+                    index=False,
+                    chunksize=CHUNK_ROWS,
+                )
+    finally:
+        engine.dispose()
+    return _has_rows(output_dfs)
+
+
+def _write_xlsx(
+    output_dfs: dict[str, pd.DataFrame],
+    audit_path: str,
+    highlights: Optional[dict[str, pd.DataFrame]] = None,
+) -> bool:
+    # An audit file from an earlier run is removed when there is nothing to write
+    audit_file_path = f"{audit_path}.xlsx"
+    if _has_rows(output_dfs):
+        return write_audit_file(output_dfs, audit_file_path, highlights)
+    if os.path.exists(audit_file_path):
+        os.remove(audit_file_path)
+    return False
+
+
+AuditSink = Callable[
+    [dict[str, pd.DataFrame], str, Optional[dict[str, pd.DataFrame]]], bool
+]
+AUDIT_SINKS: dict[str, AuditSink] = {
+    "xlsx": _write_xlsx,
+    "csv": write_csv_files,
+    "parquet": write_parquet_files,
+    "sqlite": write_sqlite,
+}
+
+
+class _Formats:
+    # Formats are created once and shared by every cell that uses them
+    def __init__(self, workbook: Any):
+        self.workbook = workbook
+        self.formats: dict[tuple[bool, Optional[str]], Any] = {}
+
+    def get(self, value: Any = None, highlighted: bool = False) -> Any:
+        if isinstance(value, datetime.datetime):
+            num_format: Optional[str] = DATETIME_FORMAT
+        elif isinstance(value, datetime.date):
+            num_format = DATE_FORMAT
+        else:
+            num_format = None
+
+        key = (highlighted, num_format)
+        if key not in self.formats:
+            properties: dict[str, Any] = {"align": "center"}
+            if highlighted:
+                properties.update(pattern=1, bg_color=HIGHLIGHT_COLOUR)
+            if num_format:
+                properties["num_format"] = num_format
+            self.formats[key] = self.workbook.add_format(properties)
+        return self.formats[key]
+
+
+def _as_text(column: pd.Series) -> pd.Series:
+    # Blanks read back from a sheet as None, whichever way they were missing
+    return column.astype(str).where(column.notna(), str(None))
+
+
+def _columnar(df: pd.DataFrame) -> pd.DataFrame:
+    # Gives each column a single type, as Parquet needs, leaving blanks as they are
+    df = df.infer_objects()
+    for column in df.select_dtypes(include="object").columns:
+        values = df[column]
+        if values.dropna().map(type).nunique() > 1:
+            df[column] = values.astype(str).where(values.notna(), None)
+    return df
+
+
+def _has_rows(output_dfs: dict[str, pd.DataFrame]) -> bool:
+    return any(not df.empty for df in output_dfs.values())
+
+
+def _manifest(parts: dict[str, list[tuple[str, int, int]]]) -> pd.DataFrame:
+    # The rows of each sheet written to each part, numbered from 1
+    return pd.DataFrame(
+        [
+            {
+                "Sheet": sheet_name,
+                "Part": part_name,
+                "First Row": start + 1,
+                "Last Row": stop,
+                "Rows": stop - start,
+            }
+            for sheet_name, sheet_parts in parts.items()
+            for part_name, start, stop in sheet_parts
+        ]
+    )
+
+
+def _paired_columns(columns: Iterable[str]) -> list[tuple[str, str, str]]:
+    # The label, NHSBT column and RR column of each pair of columns
+    columns = list(columns)
+    pairs = []
+    for column in columns:
+        label, _, source = column.rpartition(" - ")
+        rr_column = f"{label} - {SOURCES[1]}"
+        if source == SOURCES[0] and rr_column in columns:
+            pairs.append((label, column, rr_column))
+    return pairs
+
+
+def _sheet_parts(
+    sheet_name: str, rows: int, max_rows: int
+) -> list[tuple[str, int, int]]:
+    # The name and row range of each part of a sheet
+    if rows <= max_rows:
+        return [(sheet_name, 0, rows)]
+    return [
+        (f"{sheet_name}_{part}", start, min(start + max_rows, rows))
+        for part, start in enumerate(range(0, rows, max_rows), start=1)
+    ]
+
+
+def _write_sheet(
+    worksheet: Any,
+    df: pd.DataFrame,
+    mask: Optional[pd.DataFrame],
+    formats: _Formats,
+):
+    # Sets the column widths and writes the header then the rows, a chunk at a time
+    # so only one chunk of the dataframe is converted at once
+    columns = list(df.columns)
+    for i, column in enumerate(columns):
+        cell_length = max(df[column].astype(str).map(len).max(), len(column))
+        worksheet.set_column(i, i, int(cell_length) + 2, formats.get())
+    worksheet.write_row(0, 0, columns, formats.get())
+
+    no_highlights = [False] * len(columns)
+    for chunk_start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[chunk_start : chunk_start + CHUNK_ROWS]
+        values = chunk.astype(object).where(chunk.notna(), None)
+        if mask is None:
+            highlighted_rows: Iterable[list[bool]] = repeat(no_highlights)
+        else:
+            highlighted_rows = (
+                mask.iloc[chunk_start : chunk_start + CHUNK_ROWS].to_numpy().tolist()
+            )
+
+        for row_number, (row, highlighted) in enumerate(
+            zip(values.itertuples(index=False, name=None), highlighted_rows),
+            start=chunk_start + 1,
+        ):
+            for i, value in enumerate(row):
+                cell_format = formats.get(value, highlighted[i])
+                if value is None:
+                    worksheet.write_blank(row_number, i, None, cell_format)
+                else:
+                    worksheet.write(row_number, i, value, cell_format)
@@ -0,0 +1,400 @@
+"""
+This module contains the functions used by the nhsbt_import.py script to write to
+and look up records in the database in bulk rather than an object at a time.
+
+Functions:
+    bulk_insert(session, model, records, batch_size): Inserts new records with executemany
+    update_changes(session, model, changes, fields, batch_size): Updates the changed columns of records with executemany
+    bulk_update(session, model, changes, fields, batch_size): Updates changed records from a staging table
+    lookup_keys(session, query, key_column, keys, batch_size): Looks up records by joining to a temporary table of keys
+    missing_records(session, query, key_column, keys, batch_size, yield_per): Streams the records whose keys aren't in a list
+    prefetch_keys(session, targets, keys, batch_size): Looks up the records of several models by a list of keys in one query
+"""
+
+import logging
+from typing import Any, Iterable, Iterator
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    and_,
+    bindparam,
+    insert,
+    inspect,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.orm import Session
+
+log = logging.getLogger(__name__)
+
+
+def bulk_insert(session: Session, model: Any, records: list, batch_size: int = 1000):
+    """
+    Inserts new records in batches with one executemany per batch instead of adding
+    them to the session one at a time. On SQL Server this is sped up by
+    fast_executemany, which is turned on by utils.create_session. The inserts run on
+    the session's connection so they are only kept if the session is committed.
+
+    The records are read when this is called, so any changes made to them while the
+    file was processed are included.
+
+    Args:
+        session (Session): An sqlalch session
+        model (Any): The model of the records, e.g. UKTPatient
+        records (list): Transient objects of the model to insert
+        batch_size (int, optional): Rows per executemany. Defaults to 1000.
+    """
+    if not records:
+        return
+
+    log.info("Inserting %s new rows into %s", len(records), model.__table__.name)
+    _insert_rows(session, model, records, batch_size)
+
+
+def update_changes(
+    session: Session,
+    model: Any,
+    changes: dict[Any, int],
+    fields: Iterable[str],
+    batch_size: int = 1000,
+):
+    """
+    Writes only the changed columns of changed records. Records are grouped by their
+    change mask, see utils.find_patient_changes, so each group shares one UPDATE
+    statement which is run with executemany. Like bulk_insert this runs on the
+    session's connection so is only kept if the session is committed.
+
+    The records are expunged from the session first so their changes aren't also
+    flushed one UPDATE at a time. Records which aren't in the database yet, such as a
+    new patient repeated in the file, are skipped as bulk_insert writes them.
+
+    Args:
+        session (Session): An sqlalch session
+        model (Any): The model of the records, e.g. UKTPatient
+        changes (dict[Any, int]): The change mask of each changed record
+        fields (list[str]): The fields the bits of the masks refer to, e.g.
+            utils.PATIENT_FIELDS
+        batch_size (int, optional): Rows per executemany. Defaults to 1000.
+    """
+    groups = _group_changes(session, model, changes)
+    table = model.__table__
+    primary_key = list(table.primary_key.columns)
+
+    for mask, records in groups.items():
+        columns = _changed_columns(model, fields, mask)
+        if not columns:
+            continue
+
+        # Bind parameters can't share a name with a column being set
+        statement = (
+            update(table)
+            .where(
+                and_(
+                    *(column == bindparam(f"b_{column.name}") for column in primary_key)
+                )
+            )
+            .values({column.name: bindparam(f"b_{column.name}") for column in columns})
+        )
+        attributes = _column_attributes(model, primary_key + columns)
+        for start in range(0, len(records), batch_size):
+            rows = [
+                {f"b_{name}": getattr(record, key) for name, key in attributes.items()}
+                for record in records[start : start + batch_size]
+            ]
+            session.execute(statement, rows)
+
+
+def bulk_update(
+    session: Session,
+    model: Any,
+    changes: dict[Any, int],
+    fields: Iterable[str],
+    batch_size: int = 1000,
+):
+    """
+    Writes the changed columns of changed records to the database with a set based
+    UPDATE per change mask. The records are loaded with their masks into a temporary
+    staging table with executemany and the table is updated from it with UPDATE ...
+    FROM, which SQLAlchemy renders for SQL Server, PostgreSQL and SQLite. Like
+    bulk_insert this runs on the session's connection so is only kept if the session
+    is committed.
+
+    The records are expunged from the session first so their changes aren't also
+    flushed one UPDATE at a time. Records which aren't in the database yet, such as a
+    new patient repeated in the file, are skipped as bulk_insert writes them.
+
+    Args:
+        session (Session): An sqlalch session
+        model (Any): The model of the records, e.g. UKTPatient
+        changes (dict[Any, int]): The change mask of each changed record
+        fields (list[str]): The fields the bits of the masks refer to, e.g.
+            utils.PATIENT_FIELDS
+        batch_size (int, optional): Rows per executemany. Defaults to 1000.
+    """
+    groups = _group_changes(session, model, changes)
+    if not groups:
+        return
+
+    table = model.__table__
+    staging = _create_staging_table(session, table)
+    try:
+        statement = insert(staging)
+        attributes = _column_attributes(model, list(table.columns))
+        rows = [
+            {
+                **{name: getattr(record, key) for name, key in attributes.items()},
+                "CHANGES": mask,
+            }
+            for mask, records in groups.items()
+            for record in records
+        ]
+        for start in range(0, len(rows), batch_size):
+            session.execute(statement, rows[start : start + batch_size])
+
+        for mask in groups:
+            columns = _changed_columns(model, fields, mask)
+            if not columns:
+                continue
+
+            session.execute(
+                update(table)
+                .values({column.name: staging.c[column.name] for column in columns})
+                .where(
+                    and_(
+                        staging.c.CHANGES == mask,
+                        *(
+                            column == staging.c[column.name]
+                            for column in table.primary_key.columns
+                        ),
+                    )
+                )
+            )
+    finally:
+        staging.drop(session.connection())
+
+
+def lookup_keys(
+    session: Session, query: Any, key_column: Any, keys: list, batch_size: int = 1000
+) -> list:
+    """
+    Looks up the records matching a list of keys with one query. The keys are loaded
+    into a temporary table with executemany and joined to the records, which avoids
+    running a differently shaped IN list per batch of keys and the parameter limits
+    of SQL Server. The temporary table is dropped afterwards.
+
+    Args:
+        session (Session): An sqlalch session
+        query (Any): The model to look up, e.g. UKTPatient
+        key_column (Any): The column of the model the keys are for, e.g.
+            UKTPatient.uktssa_no
+        keys (list): The keys to look up. Repeats and None are ignored
+        batch_size (int, optional): Keys per executemany. Defaults to 1000.
+
+    Returns:
+        list: The matching records
+    """
+    keys = [key for key in dict.fromkeys(keys) if key is not None]
+    if not keys:
+        return []
+
+    key_table = _load_keys(session, query, key_column, keys, batch_size)
+    try:
+        results = session.scalars(
+            select(query).join(key_table, key_column == key_table.c.KEY)
+        ).all()
+    finally:
+        key_table.drop(session.connection())
+    return list(results)
+
+
+def prefetch_keys(
+    session: Session, targets: list[tuple[Any, Any]], keys: list, batch_size: int = 1000
+) -> list:
+    """
+    Looks up the records of several models matching a list of keys with one query,
+    such as the patients and deleted patients for the uktssa numbers in the file.
+    The keys are loaded into a temporary table in the same way as lookup_keys and
+    each model is outer joined to it.
+
+    Args:
+        session (Session): An sqlalch session
+        targets (list[tuple[Any, Any]]): Each model with the column the keys are
+            for, e.g. (UKTPatient, UKTPatient.uktssa_no)
+        keys (list): The keys to look up. Repeats and None are ignored
+        batch_size (int, optional): Keys per executemany. Defaults to 1000.
+
+    Returns:
+        list: Rows of the key followed by a matching record, or None, for each model.
+            Keys which match nothing are left out.
+    """
+    keys = [key for key in dict.fromkeys(keys) if key is not None]
+    if not keys:
+        return []
+
+    model, key_column = targets[0]
+    key_table = _load_keys(session, model, key_column, keys, batch_size)
+    statement = select(key_table.c.KEY, *(model for model, _ in targets)).select_from(
+        key_table
+    )
+    for model, key_column in targets:
+        statement = statement.outerjoin(model, key_column == key_table.c.KEY)
+    statement = statement.where(
+        or_(*(key_column.is_not(None) for _, key_column in targets))
+    )
+
+    try:
+        results = session.execute(statement).all()
+    finally:
+        key_table.drop(session.connection())
+    return list(results)
+
+
+def missing_records(
+    session: Session,
+    query: Any,
+    key_column: Any,
+    keys: list,
+    batch_size: int = 1000,
+    yield_per: int = 1000,
+) -> Iterator:
+    """
+    Finds the records whose keys aren't in a list, such as patients missing from the
+    NHSBT file. The keys are loaded into a temporary table once and the missing
+    records are returned by the server with an anti-join, so neither the key column
+    of the table nor the records are fetched twice. The records are streamed in
+    chunks of yield_per and the temporary table is dropped once they have all been
+    read, or when the generator is closed or raises before then.
+
+    Args:
+        session (Session): An sqlalch session
+        query (Any): The model to look up, e.g. UKTPatient
+        key_column (Any): The column of the model the keys are for, e.g.
+            UKTPatient.uktssa_no
+        keys (list): The keys which aren't missing. Repeats and None are ignored
+        batch_size (int, optional): Keys per executemany. Defaults to 1000.
+        yield_per (int, optional): Records fetched at a time. Defaults to 1000.
+
+    Yields:
+        Iterator: The missing records
+    """
+    keys = [key for key in dict.fromkeys(keys) if key is not None]
+    key_table = _load_keys(session, query, key_column, keys, batch_size)
+    try:
+        # The result is closed first so the table isn't dropped under an open cursor
+        with session.scalars(
+            select(query)
+            .outerjoin(key_table, key_column == key_table.c.KEY)
+            .where(key_table.c.KEY.is_(None))
+            .execution_options(yield_per=yield_per)
+        ) as records:
+            yield from records
+    finally:
+        key_table.drop(session.connection())
+
+
+def _group_changes(
+    session: Session, model: Any, changes: dict[Any, int]
+) -> dict[int, list]:
+    groups: dict[int, list] = {}
+    for record, mask in changes.items():
+        if inspect(record).persistent:
+            groups.setdefault(mask, []).append(record)
+
+    if count := sum(len(records) for records in groups.values()):
+        log.info(
+            "Updating %s rows in %s with %s sets of changes",
+            count,
+            model.__table__.name,
+            len(groups),
+        )
+    for records in groups.values():
+        for record in records:
+            session.expunge(record)
+    return groups
+
+
+def _changed_columns(model: Any, fields: Iterable[str], mask: int) -> list[Column]:
+    # Fields may be synonyms of the mapped columns. Keys are never updated.
+    mapper = model.__mapper__
+    columns = []
+    for bit, field in enumerate(fields):
+        if mask >> bit & 1:
+            prop = mapper.get_property(field)
+            if not hasattr(prop, "columns"):
+                prop = mapper.get_property(prop.name)
+            if not prop.columns[0].primary_key:
+                columns.append(prop.columns[0])
+    return columns
+
+
+def _column_attributes(model: Any, columns: list[Column]) -> dict[str, str]:
+    return {
+        column.name: model.__mapper__.get_property_by_column(column).key
+        for column in columns
+    }
+
+
+def _insert_rows(session: Session, model: Any, records: list, batch_size: int):
+    attributes = _column_attributes(model, list(model.__table__.columns))
+    statement = insert(model.__table__)
+
+    for start in range(0, len(records), batch_size):
+        rows = [
+            {column: getattr(record, key) for column, key in attributes.items()}
+            for record in records[start : start + batch_size]
+        ]
+        session.execute(statement, rows)
+
+
+def _load_keys(
+    session: Session, query: Any, key_column: Any, keys: list, batch_size: int
+) -> Table:
+    key_table = _create_temporary_table(
+        session,
+        f"keys_{query.__table__.name}",
+        Column("KEY", key_column.type, primary_key=True, autoincrement=False),
+    )
+    statement = insert(key_table)
+    try:
+        for start in range(0, len(keys), batch_size):
+            session.execute(
+                statement, [{"KEY": key} for key in keys[start : start + batch_size]]
+            )
+    except BaseException:
+        key_table.drop(session.connection())
+        raise
+    return key_table
+
+
+def _create_staging_table(session: Session, table: Table) -> Table:
+    return _create_temporary_table(
+        session,
+        f"staging_{table.name}",
+        *(
+            Column(
+                column.name,
+                column.type,
+                primary_key=column.primary_key,
+                autoincrement=False,
+            )
+            for column in table.columns
+        ),
+        # The change mask of each row, see bulk_update
+        Column("CHANGES", Integer, nullable=False),
+    )
+
+
+def _create_temporary_table(session: Session, name: str, *columns: Column) -> Table:
+    # SQL Server temporary tables are named with a # rather than created as TEMPORARY
+    if session.get_bind().dialect.name == "mssql":
+        name, prefixes = f"#{name}", []
+    else:
+        prefixes = ["TEMPORARY"]
+
+    temporary = Table(name, MetaData(), *columns, prefixes=prefixes)
+    temporary.create(session.connection())
+    return temporary
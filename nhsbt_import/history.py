@@ -0,0 +1,257 @@
+"""
+This module keeps the audit records of every run in an SQLite database, indexed on
+uktssa_no and registration_id, so the history of a patient or transplant can be
+looked up without opening the audit file of each run.
+
+Typical usage example:
+    Lists every audit record for a patient, oldest first
+    poetry run python -m nhsbt_import.history /path/to/history.sqlite --uktssa-no 123456
+
+    Lists only the NHS number columns of a patient's audit records
+    poetry run python -m nhsbt_import.history /path/to/history.sqlite --uktssa-no 123456 --field "NHS Number"
+
+Functions:
+    append_history(history_file_path, output_dfs, input_file_path, committed): Appends the audit records of a run
+    query_history(history_file_path, uktssa_no, registration_id, field): Finds the audit records of a patient or transplant
+    main(argv): Prints the audit records of a patient or transplant
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+from typing import Optional
+
+import pandas as pd
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Engine,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    create_engine,
+    insert,
+    select,
+)
+
+log = logging.getLogger(__name__)
+
+# Audit records are inserted this many at a time
+CHUNK_ROWS = 10_000
+
+metadata = MetaData()
+
+runs = Table(
+    "runs",
+    metadata,
+    Column("run_id", Integer, primary_key=True),
+    Column("run_at", DateTime, nullable=False),
+    Column("input_file", String, nullable=False),
+    Column("committed", Boolean, nullable=False),
+)
+
+audit_records = Table(
+    "audit_records",
+    metadata,
+    Column("record_id", Integer, primary_key=True),
+    Column("run_id", ForeignKey("runs.run_id"), nullable=False, index=True),
+    Column("sheet", String, nullable=False),
+    Column("uktssa_no", Integer, index=True),
+    Column("registration_id", String, index=True),
+    Column("record", Text, nullable=False),
+)
+
+
+def append_history(
+    history_file_path: str,
+    output_dfs: dict[str, pd.DataFrame],
+    input_file_path: str,
+    committed: bool = False,
+    run_at: Optional[datetime.datetime] = None,
+) -> int:
+    """
+    Appends every row of the output dataframes to the history as a run. Each row is
+    kept as JSON, alongside its sheet and the uktssa_no and registration_id it is
+    about. The database and its tables are created if they don't exist.
+
+    Args:
+        history_file_path (str): The SQLite history file
+        output_dfs (dict[str, pd.DataFrame]): The output dataframes keyed by sheet
+        input_file_path (str): The NHSBT file of the run
+        committed (bool, optional): Whether the run's changes were committed.
+            Defaults to False.
+        run_at (Optional[datetime.datetime], optional): When the run happened.
+            Defaults to now.
+
+    Returns:
+        int: The run_id of the run
+    """
+    engine = _create_engine(history_file_path)
+    try:
+        with engine.begin() as connection:
+            run_id = connection.execute(
+                insert(runs)
+                .values(
+                    run_at=run_at or datetime.datetime.now(),
+                    input_file=input_file_path,
+                    committed=committed,
+                )
+                .returning(runs.c.run_id)
+            ).scalar_one()
+
+            count = 0
+            for sheet_name, df in output_dfs.items():
+                for chunk_start in range(0, len(df), CHUNK_ROWS):
+                    chunk = df.iloc[chunk_start : chunk_start + CHUNK_ROWS]
+                    rows = [
+                        _history_row(run_id, sheet_name, record)
+                        for record in chunk.astype(object)
+                        .where(chunk.notna(), None)
+                        .to_dict("records")
+                    ]
+                    connection.execute(insert(audit_records), rows)
+                    count += len(rows)
+    finally:
+        engine.dispose()
+
+    log.info("Added %s audit records to %s as run %s", count, history_file_path, run_id)
+    return run_id
+
+
+def query_history(
+    history_file_path: str,
+    uktssa_no: Optional[int] = None,
+    registration_id: Optional[str] = None,
+    field: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Finds the audit records of a patient or a transplant across every run, oldest
+    first. Both uktssa_no and registration_id use an index so only the matching
+    records are read.
+
+    Args:
+        history_file_path (str): The SQLite history file
+        uktssa_no (Optional[int], optional): The patient to look up. Defaults to None.
+        registration_id (Optional[str], optional): The transplant to look up.
+            Defaults to None.
+        field (Optional[str], optional): Only keep the records with a
+            "<field> - NHSBT" or "<field> - RR" column, and only those columns, e.g.
+            "NHS Number". Defaults to None, which keeps every record and column.
+
+    Raises:
+        ValueError: Neither uktssa_no nor registration_id were given
+        FileNotFoundError: The history file doesn't exist
+
+    Returns:
+        pd.DataFrame: A row for each audit record, with the run it came from
+    """
+    if uktssa_no is None and registration_id is None:
+        raise ValueError("A uktssa_no or registration_id is needed")
+    if not os.path.isfile(history_file_path):
+        raise FileNotFoundError(f"{history_file_path} not found")
+
+    query = (
+        select(
+            runs.c.run_at,
+            runs.c.input_file,
+            runs.c.committed,
+            audit_records.c.sheet,
+            audit_records.c.record,
+        )
+        .join(runs, runs.c.run_id == audit_records.c.run_id)
+        .order_by(runs.c.run_at, audit_records.c.record_id)
+    )
+    if uktssa_no is not None:
+        query = query.where(audit_records.c.uktssa_no == uktssa_no)
+    if registration_id is not None:
+        query = query.where(audit_records.c.registration_id == registration_id)
+
+    engine = _create_engine(history_file_path)
+    try:
+        with engine.connect() as connection:
+            rows = connection.execute(query).all()
+    finally:
+        engine.dispose()
+
+    history = []
+    for row in rows:
+        record = json.loads(row.record)
+        if field is not None:
+            columns = [f"{field} - {source}" for source in ("NHSBT", "RR")]
+            if not any(column in record for column in columns):
+                continue
+            record = {
+                column: record[column]
+                for column in ["Match Type"] + columns
+                if column in record
+            }
+        history.append(
+            {
+                "Run At": row.run_at,
+                "Input File": row.input_file,
+                "Committed": row.committed,
+                "Sheet": row.sheet,
+                **record,
+            }
+        )
+    return pd.DataFrame(history, dtype=object)
+
+
+def main(argv=None):
+    """
+    Prints the audit records of a patient or transplant from the history file.
+
+    Args:
+        argv (list, optional): List of inputs. Defaults to None.
+    """
+    parser = argparse.ArgumentParser(description="nhsbt_import history")
+    parser.add_argument("history_file", type=str, help="The SQLite history file")
+    parser.add_argument("--uktssa-no", type=int, help="The patient to look up")
+    parser.add_argument("--registration-id", type=str, help="The transplant to look up")
+    parser.add_argument(
+        "--field",
+        type=str,
+        help='Only show the NHSBT and RR columns of a field, e.g. "NHS Number"',
+    )
+    args = parser.parse_args(argv)
+
+    if args.uktssa_no is None and args.registration_id is None:
+        parser.error("--uktssa-no or --registration-id is needed")
+
+    history = query_history(
+        args.history_file, args.uktssa_no, args.registration_id, args.field
+    )
+    if history.empty:
+        print("No audit records found")
+    else:
+        print(history.to_string(index=False))
+
+
+def _create_engine(history_file_path: str) -> Engine:
+    engine = create_engine(f"sqlite:///{history_file_path}")
+    metadata.create_all(engine)
+    return engine
+
+
+def _history_row(run_id: int, sheet_name: str, record: dict) -> dict:
+    # The registration id is from the NHSBT file, or the database when missing
+    registration_id = record.get("Registration ID - NHSBT") or record.get(
+        "Registration ID - RR"
+    )
+    return {
+        "run_id": run_id,
+        "sheet": sheet_name,
+        "uktssa_no": record.get("UKTSSA_No"),
+        "registration_id": registration_id,
+        "record": json.dumps(record, default=str),
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import datetime
+import logging
+import sqlite3
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+from nhsbt_import import audit, utils
+
+
+def test_write_audit_file(tmp_path):
+    audit_file_path = str(tmp_path / "audit.xlsx")
+    output_dfs = {
+        "updated_patients": pd.DataFrame(
+            {
+                "Match Type": ["Update", "Update"],
+                "Surname - NHSBT": ["SMITH", "JONES"],
+                "Surname - RR": ["SMYTH", "JONES"],
+                "Date of Birth - NHSBT": [datetime.datetime(1980, 1, 2), None],
+            }
+        ),
+        "new_transplants": pd.DataFrame({"Match Type": []}),
+    }
+
+    highlights = {
+        "updated_patients": audit.difference_mask(
+            output_dfs["updated_patients"], [["Surname"], []]
+        )
+    }
+
+    written = audit.write_audit_file(output_dfs, audit_file_path, highlights)
+
+    assert written is True
+    wb = load_workbook(audit_file_path)
+    assert wb.sheetnames == ["updated_patients"]
+
+    sheet = wb["updated_patients"]
+    assert [[cell.value for cell in row] for row in sheet.iter_rows()] == [
+        ["Match Type", "Surname - NHSBT", "Surname - RR", "Date of Birth - NHSBT"],
+        ["Update", "SMITH", "SMYTH", datetime.datetime(1980, 1, 2)],
+        ["Update", "JONES", "JONES", None],
+    ]
+    highlighted = [
+        [cell.fill.fgColor.rgb == "FFADD8E6" for cell in row]
+        for row in sheet.iter_rows(min_row=2)
+    ]
+    assert highlighted == [[False, True, True, False], [False, False, False, False]]
+    assert sheet["B2"].alignment.horizontal == "center"
+    assert int(sheet.column_dimensions["A"].width) == len("Match Type") + 2
+
+
+def test_difference_mask():
+    df = pd.DataFrame(
+        {
+            "UKTSSA_No": [1, 2, 3],
+            "Surname - NHSBT": ["SMITH", "JONES", None],
+            "Surname - RR": ["SMYTH", "JONES", float("nan")],
+            "Sex - NHSBT": ["1", 2, "2"],
+            "Sex - RR": [1, 2, "1"],
+            "Postcode - RR": ["AB1 2CD", None, None],
+        }
+    )
+
+    assert audit.difference_mask(df).to_numpy().tolist() == [
+        [False, True, True, False, False, False],
+        [False, False, False, False, False, False],
+        [False, False, False, True, True, False],
+    ]
+    assert audit.difference_mask(
+        df, [["Sex"], [], ["Surname"]]
+    ).to_numpy().tolist() == [
+        [False, False, False, True, True, False],
+        [False, False, False, False, False, False],
+        [False, True, True, False, False, False],
+    ]
+
+
+def test_write_audit_file_empty(tmp_path, caplog):
+    audit_file_path = tmp_path / "audit.xlsx"
+
+    with caplog.at_level(logging.INFO):
+        written = audit.write_audit_file(
+            {"new_patients": pd.DataFrame()}, str(audit_file_path)
+        )
+
+    assert written is False
+    assert not audit_file_path.exists()
+    assert "Nothing to write to audit file" in caplog.text
+
+
+def test_write_audit_file_split(tmp_path):
+    audit_file_path = str(tmp_path / "audit.xlsx")
+    updated = pd.DataFrame(
+        {
+            "UKTSSA_No": [1, 2, 3, 4, 5],
+            "Surname - NHSBT": ["A", "B", "C", "D", "E"],
+            "Surname - RR": ["A", "B", "C", "X", "E"],
+        }
+    )
+    output_dfs = {
+        "new_patients": pd.DataFrame({"UKTSSA_No": [6]}),
+        "updated_patients": updated,
+    }
+
+    audit.write_audit_file(
+        output_dfs,
+        audit_file_path,
+        {"updated_patients": audit.difference_mask(updated)},
+        max_rows=2,
+    )
+
+    wb = load_workbook(audit_file_path)
+    assert wb.sheetnames == [
+        "manifest",
+        "new_patients",
+        "updated_patients_1",
+        "updated_patients_2",
+        "updated_patients_3",
+    ]
+    assert [list(row) for row in wb["manifest"].iter_rows(values_only=True)] == [
+        ["Sheet", "Part", "First Row", "Last Row", "Rows"],
+        ["new_patients", "new_patients", 1, 1, 1],
+        ["updated_patients", "updated_patients_1", 1, 2, 2],
+        ["updated_patients", "updated_patients_2", 3, 4, 2],
+        ["updated_patients", "updated_patients_3", 5, 5, 1],
+    ]
+
+    part = wb["updated_patients_2"]
+    assert [list(row) for row in part.iter_rows(values_only=True)] == [
+        ["UKTSSA_No", "Surname - NHSBT", "Surname - RR"],
+        [3, "C", "C"],
+        [4, "D", "X"],
+    ]
+    assert [cell.fill.fgColor.rgb == "FFADD8E6" for cell in part[3]] == [
+        False,
+        True,
+        True,
+    ]
+
+
+def test_write_audit(tmp_path):
+    audit_file_path = str(tmp_path / "audit.xlsx")
+    output_dfs = {
+        "new_patients": pd.DataFrame(
+            {
+                "UKTSSA_No": [1, 2],
+                "Surname - NHSBT": ["SMITH", None],
+                "Date Birth - NHSBT": [datetime.date(1980, 1, 2), None],
+            }
+        ),
+        "missing_patients": pd.DataFrame({"UKTSSA_No": []}),
+    }
+
+    assert audit.write_audit(output_dfs, audit_file_path, ["csv", "sqlite"])
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["audit", "audit.sqlite"]
+    assert sorted(path.name for path in (tmp_path / "audit").iterdir()) == [
+        "missing_patients.csv",
+        "new_patients.csv",
+    ]
+    assert (tmp_path / "audit" / "missing_patients.csv").read_text() == "UKTSSA_No\n"
+    assert (tmp_path / "audit" / "new_patients.csv").read_text().splitlines() == [
+        "UKTSSA_No,Surname - NHSBT,Date Birth - NHSBT",
+        "1,SMITH,1980-01-02",
+        "2,,",
+    ]
+    with sqlite3.connect(tmp_path / "audit.sqlite") as connection:
+        rows = connection.execute("SELECT * FROM new_patients").fetchall()
+    assert rows == [(1, "SMITH", "1980-01-02"), (2, None, None)]
+    with sqlite3.connect(tmp_path / "audit.sqlite") as connection:
+        rows = connection.execute("SELECT * FROM missing_patients").fetchall()
+    assert rows == []
+
+    with pytest.raises(ValueError) as excinfo:
+        audit.write_audit(output_dfs, audit_file_path, ["xlsx", "json"])
+    assert str(excinfo.value) == "json is not an audit format"
+
+
+def test_write_audit_replaces_earlier_run(tmp_path):
+    audit_file_path = str(tmp_path / "audit.xlsx")
+    audit_formats = ["xlsx", "csv", "sqlite"]
+    columns = {"UKTSSA_No": [1], "Surname - NHSBT": ["SMITH"]}
+
+    audit.write_audit(
+        {"new_patients": pd.DataFrame(columns)}, audit_file_path, audit_formats
+    )
+    written = audit.write_audit(
+        {"new_patients": pd.DataFrame(columns).iloc[:0]},
+        audit_file_path,
+        audit_formats,
+    )
+
+    assert written is False
+    assert not (tmp_path / "audit.xlsx").exists()
+    assert (tmp_path / "audit" / "new_patients.csv").read_text().splitlines() == [
+        "UKTSSA_No,Surname - NHSBT"
+    ]
+    with sqlite3.connect(tmp_path / "audit.sqlite") as connection:
+        rows = connection.execute("SELECT * FROM new_patients").fetchall()
+    assert rows == []
+
+
+def test_write_audit_csv_next_run(tmp_path):
+    # The CSV audit of one run mustn't be taken for the NHSBT file of the next
+    input_file_path = tmp_path / "nhsbt.csv"
+    input_file_path.write_text("1,2,3\n")
+    output_dfs = {"new_patients": pd.DataFrame({"UKTSSA_No": [1]})}
+
+    for _ in range(2):
+        assert utils.get_input_file_path(str(tmp_path)) == str(input_file_path)
+        audit.write_audit(output_dfs, str(tmp_path / "audit.xlsx"), ["xlsx", "csv"])
+
+
+def test_write_parquet_files(tmp_path, mocker):
+    to_parquet = mocker.patch.object(pd.DataFrame, "to_parquet", autospec=True)
+    output_dfs = {
+        "new_patients": pd.DataFrame(
+            {"UKTSSA_No": [1, 2], "Sex - NHSBT": ["1", 2]}, dtype=object
+        )
+    }
+
+    assert audit.write_parquet_files(output_dfs, str(tmp_path / "audit"))
+
+    df, path = to_parquet.call_args.args
+    assert path == str(tmp_path / "audit" / "new_patients.parquet")
+    assert df["UKTSSA_No"].tolist() == [1, 2]
+    assert df["Sex - NHSBT"].tolist() == ["1", "2"]
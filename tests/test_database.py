@@ -0,0 +1,512 @@
+import datetime
+
+import pytest
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.orm import Session, sessionmaker
+from ukrr_models import nhsbt_models  # type: ignore
+
+from nhsbt_import import database, utils
+
+
+@pytest.fixture()
+def nhsbt_session():
+    engine = create_engine("sqlite:///:memory:")
+    nhsbt_models.Base.metadata.create_all(bind=engine)
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    yield session
+
+    session.rollback()
+    session.close()
+
+
+def _patient(uktssa_no: int, surname: str = "TestSurname") -> nhsbt_models.UKTPatient:
+    return nhsbt_models.UKTPatient(
+        uktssa_no=uktssa_no,
+        surname=surname,
+        forename="TestForename",
+        sex="1",
+        post_code="AB1 2CD",
+        new_nhs_no=4000000011,
+        chi_no=1234567890,
+        hsc_no=3200000001,
+        rr_no=2222222222,
+        ukt_date_death=datetime.datetime(2020, 1, 1),
+        ukt_date_birth=datetime.datetime(1980, 1, 1),
+    )
+
+
+def _transplant(registration_id: str) -> nhsbt_models.UKTTransplant:
+    return nhsbt_models.UKTTransplant(
+        registration_id=registration_id,
+        uktssa_no=int(registration_id.split("_")[0]),
+        transplant_id=2000,
+        transplant_type="LD",
+        transplant_organ="Kidney",
+        transplant_unit="RFR01",
+        rr_no=3000,
+        transplant_date=datetime.datetime(2020, 1, 1),
+        ukt_fail_date=datetime.datetime(2021, 1, 1),
+        registration_date=datetime.datetime(2019, 1, 1),
+        registration_date_type="A",
+        registration_end_date=datetime.datetime(2020, 1, 1),
+        registration_end_status="TX",
+        transplant_consideration="1",
+        transplant_dialysis="Y",
+        transplant_relationship="1",
+        transplant_sex="1",
+        cause_of_failure="12",
+        cause_of_failure_text="Rejection",
+        cit_mins="720",
+        hla_mismatch="1 1 0",
+        ukt_suspension=False,
+    )
+
+
+def test_bulk_insert(nhsbt_session: Session):
+    patients = [_patient(uktssa_no) for uktssa_no in range(1, 6)]
+    # Changes made before the insert are included
+    patients[0].surname = "Changed"
+
+    database.bulk_insert(nhsbt_session, nhsbt_models.UKTPatient, patients, batch_size=2)
+
+    rows = nhsbt_session.execute(
+        select(nhsbt_models.UKTPatient.uktssa_no, nhsbt_models.UKTPatient.surname)
+    ).all()
+    assert sorted(rows) == [
+        (1, "Changed"),
+        (2, "TestSurname"),
+        (3, "TestSurname"),
+        (4, "TestSurname"),
+        (5, "TestSurname"),
+    ]
+
+
+def test_bulk_insert_transplants(nhsbt_session: Session):
+    transplants = [_transplant("100_1"), _transplant("100_2")]
+
+    database.bulk_insert(nhsbt_session, nhsbt_models.UKTTransplant, transplants)
+
+    result = nhsbt_session.get(nhsbt_models.UKTTransplant, "100_2")
+    assert result.uktssa_no == 100
+    assert result.registration_date == datetime.datetime(2019, 1, 1)
+    assert result.ukt_suspension is False
+
+
+def test_bulk_insert_rolled_back(nhsbt_session: Session):
+    database.bulk_insert(nhsbt_session, nhsbt_models.UKTPatient, [_patient(1)])
+    nhsbt_session.rollback()
+
+    count = nhsbt_session.scalar(select(func.count(nhsbt_models.UKTPatient.uktssa_no)))
+    assert count == 0
+
+
+def test_bulk_insert_nothing(nhsbt_session: Session, mocker):
+    execute = mocker.spy(nhsbt_session, "execute")
+
+    database.bulk_insert(nhsbt_session, nhsbt_models.UKTPatient, [])
+
+    execute.assert_not_called()
+
+
+def _changes(records: list, fields: dict, **changed) -> dict:
+    # Applies the changes as update_nhsbt_patient would and returns the change masks
+    changes = {}
+    for record in records:
+        for field, value in changed.items():
+            setattr(record, field, value)
+        changes[record] = utils.field_mask(fields, list(changed))
+    return changes
+
+
+def _record_statements(session: Session) -> list[str]:
+    statements: list[str] = []
+    event.listen(
+        session.get_bind(),
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    return statements
+
+
+def _fail_once(session: Session, prefix: str):
+    # Makes the next statement starting with prefix raise, as a dropped connection would
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.startswith(prefix):
+            event.remove(
+                session.get_bind(), "before_cursor_execute", before_cursor_execute
+            )
+            raise RuntimeError("Connection lost")
+
+    event.listen(session.get_bind(), "before_cursor_execute", before_cursor_execute)
+
+
+def _load_patients(session: Session) -> dict:
+    session.add_all([_patient(uktssa_no) for uktssa_no in range(1, 6)])
+    session.commit()
+    return {
+        patient.uktssa_no: patient
+        for patient in session.scalars(select(nhsbt_models.UKTPatient))
+    }
+
+
+def test_update_changes(nhsbt_session: Session):
+    patients = _load_patients(nhsbt_session)
+    changes = {
+        **_changes([patients[1], patients[2]], utils.PATIENT_FIELDS, surname="Same"),
+        **_changes(
+            [patients[3]], utils.PATIENT_FIELDS, surname="Three", forename="Changed"
+        ),
+        # A new patient repeated in the file is written by bulk_insert
+        _patient(9): 1,
+    }
+
+    statements = _record_statements(nhsbt_session)
+    database.update_changes(
+        nhsbt_session, nhsbt_models.UKTPatient, changes, utils.PATIENT_FIELDS
+    )
+    nhsbt_session.commit()
+
+    updates = [statement for statement in statements if statement.startswith("UPDATE")]
+    # One executemany for each set of changed columns
+    assert len(updates) == 2
+    assert "FORENAME" not in updates[0]
+    assert "FORENAME" in updates[1]
+    assert "NHS_NO" not in "".join(updates)
+    rows = nhsbt_session.execute(
+        select(
+            nhsbt_models.UKTPatient.uktssa_no,
+            nhsbt_models.UKTPatient.surname,
+            nhsbt_models.UKTPatient.forename,
+        )
+    ).all()
+    assert sorted(rows) == [
+        (1, "Same", "TestForename"),
+        (2, "Same", "TestForename"),
+        (3, "Three", "Changed"),
+        (4, "TestSurname", "TestForename"),
+        (5, "TestSurname", "TestForename"),
+    ]
+
+
+def test_update_changes_transplants(nhsbt_session: Session):
+    nhsbt_session.add_all([_transplant("100_1"), _transplant("100_2")])
+    nhsbt_session.commit()
+    transplant = nhsbt_session.get(nhsbt_models.UKTTransplant, "100_2")
+    changes = _changes(
+        [transplant],
+        utils.TRANSPLANT_FIELDS,
+        ukt_suspension=True,
+        ukt_fail_date=datetime.datetime(2023, 4, 5),
+        registration_id="100_2",
+    )
+
+    database.update_changes(
+        nhsbt_session, nhsbt_models.UKTTransplant, changes, utils.TRANSPLANT_FIELDS
+    )
+    nhsbt_session.commit()
+
+    result = nhsbt_session.get(nhsbt_models.UKTTransplant, "100_2")
+    assert result.ukt_suspension is True
+    assert result.ukt_fail_date == datetime.datetime(2023, 4, 5)
+    assert (
+        nhsbt_session.get(nhsbt_models.UKTTransplant, "100_1").ukt_suspension is False
+    )
+
+
+def test_bulk_update(nhsbt_session: Session):
+    patients = _load_patients(nhsbt_session)
+    changes = {
+        **_changes([patients[1], patients[2]], utils.PATIENT_FIELDS, surname="Same"),
+        **_changes(
+            [patients[3]], utils.PATIENT_FIELDS, surname="Three", forename="Changed"
+        ),
+        _patient(9): 1,
+    }
+
+    statements = _record_statements(nhsbt_session)
+    database.bulk_update(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        changes,
+        utils.PATIENT_FIELDS,
+        batch_size=1,
+    )
+    nhsbt_session.commit()
+
+    updates = [statement for statement in statements if statement.startswith("UPDATE")]
+    # One UPDATE ... FROM for each set of changed columns
+    assert len(updates) == 2
+    assert all("FROM" in update for update in updates)
+    assert "FORENAME" not in updates[0]
+    assert "FORENAME" in updates[1]
+    rows = nhsbt_session.execute(
+        select(
+            nhsbt_models.UKTPatient.uktssa_no,
+            nhsbt_models.UKTPatient.surname,
+            nhsbt_models.UKTPatient.forename,
+        )
+    ).all()
+    assert sorted(rows) == [
+        (1, "Same", "TestForename"),
+        (2, "Same", "TestForename"),
+        (3, "Three", "Changed"),
+        (4, "TestSurname", "TestForename"),
+        (5, "TestSurname", "TestForename"),
+    ]
+
+
+def test_bulk_update_transplants(nhsbt_session: Session):
+    nhsbt_session.add_all([_transplant("100_1"), _transplant("100_2")])
+    nhsbt_session.commit()
+    transplant = nhsbt_session.get(nhsbt_models.UKTTransplant, "100_2")
+    changes = _changes(
+        [transplant],
+        utils.TRANSPLANT_FIELDS,
+        ukt_suspension=True,
+        ukt_fail_date=datetime.datetime(2023, 4, 5),
+    )
+
+    database.bulk_update(
+        nhsbt_session, nhsbt_models.UKTTransplant, changes, utils.TRANSPLANT_FIELDS
+    )
+    nhsbt_session.commit()
+
+    result = nhsbt_session.get(nhsbt_models.UKTTransplant, "100_2")
+    assert result.ukt_suspension is True
+    assert result.ukt_fail_date == datetime.datetime(2023, 4, 5)
+    assert (
+        nhsbt_session.get(nhsbt_models.UKTTransplant, "100_1").ukt_suspension is False
+    )
+
+
+def test_bulk_update_rolled_back(nhsbt_session: Session):
+    nhsbt_session.add(_patient(1))
+    nhsbt_session.commit()
+    patient = nhsbt_session.get(nhsbt_models.UKTPatient, 1)
+    changes = _changes([patient], utils.PATIENT_FIELDS, surname="Changed")
+
+    database.bulk_update(
+        nhsbt_session, nhsbt_models.UKTPatient, changes, utils.PATIENT_FIELDS
+    )
+    nhsbt_session.rollback()
+
+    assert nhsbt_session.get(nhsbt_models.UKTPatient, 1).surname == "TestSurname"
+
+
+def test_lookup_keys(nhsbt_session: Session):
+    nhsbt_session.add_all([_patient(uktssa_no) for uktssa_no in range(1, 11)])
+    nhsbt_session.commit()
+
+    statements = _record_statements(nhsbt_session)
+    results = database.lookup_keys(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [8, 2, 99, 4, 2, None, 6],
+        batch_size=2,
+    )
+
+    assert sorted(patient.uktssa_no for patient in results) == [2, 4, 6, 8]
+    selects = [statement for statement in statements if statement.startswith("SELECT")]
+    assert len(selects) == 1
+    assert "JOIN" in selects[0]
+    assert " IN " not in selects[0]
+    # The temporary table is dropped so it can be used again
+    assert database.lookup_keys(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [3],
+    ) == [nhsbt_session.get(nhsbt_models.UKTPatient, 3)]
+
+
+def test_lookup_keys_transplants(nhsbt_session: Session):
+    nhsbt_session.add_all([_transplant("100_1"), _transplant("100_2")])
+    nhsbt_session.commit()
+
+    results = database.lookup_keys(
+        nhsbt_session,
+        nhsbt_models.UKTTransplant,
+        nhsbt_models.UKTTransplant.registration_id,
+        ["100_2", "200_1"],
+    )
+
+    assert [transplant.registration_id for transplant in results] == ["100_2"]
+
+
+def test_lookup_keys_nothing(nhsbt_session: Session, mocker):
+    execute = mocker.spy(nhsbt_session, "execute")
+
+    results = database.lookup_keys(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [None],
+    )
+
+    assert results == []
+    execute.assert_not_called()
+
+
+def test_missing_records(nhsbt_session: Session):
+    nhsbt_session.add_all([_patient(uktssa_no) for uktssa_no in range(1, 8)])
+    nhsbt_session.commit()
+
+    statements = _record_statements(nhsbt_session)
+    missing = database.missing_records(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [1, 3, 3, 99, None, 5, 7],
+        batch_size=2,
+        yield_per=2,
+    )
+
+    assert sorted(patient.uktssa_no for patient in missing) == [2, 4, 6]
+    selects = [statement for statement in statements if statement.startswith("SELECT")]
+    assert len(selects) == 1
+    assert "LEFT OUTER JOIN" in selects[0]
+
+
+def test_missing_records_transplants(nhsbt_session: Session):
+    nhsbt_session.add_all([_transplant("100_1"), _transplant("100_2")])
+    nhsbt_session.commit()
+
+    missing = database.missing_records(
+        nhsbt_session,
+        nhsbt_models.UKTTransplant,
+        nhsbt_models.UKTTransplant.registration_id,
+        ["100_2"],
+    )
+
+    assert [transplant.registration_id for transplant in missing] == ["100_1"]
+    # Every record is missing if there are no keys
+    missing = database.missing_records(
+        nhsbt_session,
+        nhsbt_models.UKTTransplant,
+        nhsbt_models.UKTTransplant.registration_id,
+        [],
+    )
+    assert len(list(missing)) == 2
+
+
+def test_prefetch_keys(nhsbt_session: Session):
+    nhsbt_session.add_all([_patient(100), _patient(200)])
+    nhsbt_session.add_all([_transplant("100_1"), _transplant("100_2")])
+    nhsbt_session.add(_transplant("300_1"))
+    nhsbt_session.commit()
+
+    statements = _record_statements(nhsbt_session)
+    rows = database.prefetch_keys(
+        nhsbt_session,
+        [
+            (nhsbt_models.UKTPatient, nhsbt_models.UKTPatient.uktssa_no),
+            (nhsbt_models.UKTTransplant, nhsbt_models.UKTTransplant.uktssa_no),
+        ],
+        [100, 200, 300, 400],
+    )
+
+    selects = [statement for statement in statements if statement.startswith("SELECT")]
+    assert len(selects) == 1
+    assert sorted(
+        (
+            key,
+            patient.uktssa_no if patient else None,
+            transplant.registration_id if transplant else None,
+        )
+        for key, patient, transplant in rows
+    ) == [
+        (100, 100, "100_1"),
+        (100, 100, "100_2"),
+        (200, 200, None),
+        (300, None, "300_1"),
+    ]
+
+
+def test_missing_records_closed(nhsbt_session: Session):
+    nhsbt_session.add_all([_patient(uktssa_no) for uktssa_no in range(1, 6)])
+    nhsbt_session.commit()
+
+    missing = database.missing_records(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [1],
+        yield_per=1,
+    )
+    next(missing)
+    missing.close()
+
+    # The temporary table was dropped so it can be used again
+    missing = database.missing_records(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [1, 2],
+    )
+    assert sorted(patient.uktssa_no for patient in missing) == [3, 4, 5]
+
+
+@pytest.mark.parametrize("prefix", ["INSERT", "SELECT"])
+def test_lookup_keys_error(nhsbt_session: Session, prefix: str):
+    nhsbt_session.add_all([_patient(uktssa_no) for uktssa_no in range(1, 4)])
+    nhsbt_session.commit()
+
+    _fail_once(nhsbt_session, prefix)
+    with pytest.raises(RuntimeError):
+        database.lookup_keys(
+            nhsbt_session,
+            nhsbt_models.UKTPatient,
+            nhsbt_models.UKTPatient.uktssa_no,
+            [1, 2],
+        )
+
+    # The temporary table was dropped so it can be used again
+    results = database.lookup_keys(
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        [1, 2],
+    )
+    assert sorted(patient.uktssa_no for patient in results) == [1, 2]
+
+
+def test_prefetch_keys_error(nhsbt_session: Session):
+    nhsbt_session.add(_patient(100))
+    nhsbt_session.commit()
+    targets = [(nhsbt_models.UKTPatient, nhsbt_models.UKTPatient.uktssa_no)]
+
+    _fail_once(nhsbt_session, "SELECT")
+    with pytest.raises(RuntimeError):
+        database.prefetch_keys(nhsbt_session, targets, [100])
+
+    rows = database.prefetch_keys(nhsbt_session, targets, [100])
+    assert [(key, patient.uktssa_no) for key, patient in rows] == [(100, 100)]
+
+
+def test_bulk_update_error(nhsbt_session: Session):
+    patients = _load_patients(nhsbt_session)
+    changes = _changes([patients[1]], utils.PATIENT_FIELDS, surname="Changed")
+
+    _fail_once(nhsbt_session, "UPDATE")
+    with pytest.raises(RuntimeError):
+        database.bulk_update(
+            nhsbt_session, nhsbt_models.UKTPatient, changes, utils.PATIENT_FIELDS
+        )
+
+    # The staging table was dropped so it can be used again
+    nhsbt_session.add(patients[1])
+    database.bulk_update(
+        nhsbt_session, nhsbt_models.UKTPatient, changes, utils.PATIENT_FIELDS
+    )
+    assert (
+        nhsbt_session.scalar(
+            select(nhsbt_models.UKTPatient.surname).where(
+                nhsbt_models.UKTPatient.uktssa_no == 1
+            )
+        )
+        == "Changed"
+    )
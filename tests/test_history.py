@@ -0,0 +1,136 @@
+import datetime
+
+import pandas as pd
+import pytest
+from ukrr_models import nhsbt_models  # type: ignore
+
+from nhsbt_import import history, utils
+from nhsbt_import.df_columns import df_columns
+
+
+def _output_dfs(nhs_number: int) -> dict[str, pd.DataFrame]:
+    return {
+        "updated_patients": pd.DataFrame(
+            {
+                "UKTSSA_No": [100, 200],
+                "Match Type": ["Update", "Update"],
+                "NHS Number - NHSBT": [nhs_number, 9434765919],
+                "NHS Number - RR": [9434765870, None],
+                "Date Birth - NHSBT": [datetime.datetime(1980, 1, 2), None],
+            }
+        ),
+        "missing_transplants": pd.DataFrame(
+            {
+                "UKTSSA_No": [100],
+                "Registration ID - RR": ["100_1"],
+            }
+        ),
+        "new_patients": pd.DataFrame({"UKTSSA_No": []}),
+    }
+
+
+def test_append_and_query_history(tmp_path):
+    history_file_path = str(tmp_path / "history.sqlite")
+
+    first = history.append_history(
+        history_file_path,
+        _output_dfs(9434765919),
+        "january.csv",
+        run_at=datetime.datetime(2024, 1, 1),
+    )
+    second = history.append_history(
+        history_file_path,
+        _output_dfs(9434765870),
+        "february.csv",
+        committed=True,
+        run_at=datetime.datetime(2024, 2, 1),
+    )
+    assert (first, second) == (1, 2)
+
+    records = history.query_history(history_file_path, uktssa_no=100)
+    assert records["Input File"].tolist() == [
+        "january.csv",
+        "january.csv",
+        "february.csv",
+        "february.csv",
+    ]
+    assert records["Committed"].tolist() == [False, False, True, True]
+    assert records["Sheet"].tolist() == [
+        "updated_patients",
+        "missing_transplants",
+        "updated_patients",
+        "missing_transplants",
+    ]
+    assert records["Date Birth - NHSBT"].tolist()[0] == "1980-01-02 00:00:00"
+
+    records = history.query_history(history_file_path, 100, field="NHS Number")
+    assert records.to_dict("records") == [
+        {
+            "Run At": datetime.datetime(2024, 1, 1),
+            "Input File": "january.csv",
+            "Committed": False,
+            "Sheet": "updated_patients",
+            "Match Type": "Update",
+            "NHS Number - NHSBT": 9434765919,
+            "NHS Number - RR": 9434765870,
+        },
+        {
+            "Run At": datetime.datetime(2024, 2, 1),
+            "Input File": "february.csv",
+            "Committed": True,
+            "Sheet": "updated_patients",
+            "Match Type": "Update",
+            "NHS Number - NHSBT": 9434765870,
+            "NHS Number - RR": 9434765870,
+        },
+    ]
+
+    records = history.query_history(history_file_path, registration_id="100_1")
+    assert records["Input File"].tolist() == ["january.csv", "february.csv"]
+    assert history.query_history(history_file_path, uktssa_no=300).empty
+
+
+def test_query_history_errors(tmp_path):
+    with pytest.raises(ValueError):
+        history.query_history(str(tmp_path / "history.sqlite"))
+
+    with pytest.raises(FileNotFoundError):
+        history.query_history(str(tmp_path / "history.sqlite"), uktssa_no=100)
+
+
+def test_main(tmp_path, capsys):
+    history_file_path = str(tmp_path / "history.sqlite")
+    history.append_history(history_file_path, _output_dfs(9434765919), "january.csv")
+
+    history.main([history_file_path, "--uktssa-no", "200", "--field", "NHS Number"])
+    output = capsys.readouterr().out
+    assert "january.csv" in output
+    assert "9434765919" in output
+
+    history.main([history_file_path, "--registration-id", "200_1"])
+    assert capsys.readouterr().out == "No audit records found\n"
+
+    with pytest.raises(SystemExit):
+        history.main([history_file_path])
+
+
+def test_query_history_new_transplant(tmp_path):
+    history_file_path = str(tmp_path / "history.sqlite")
+    transplant = nhsbt_models.UKTTransplant(
+        uktssa_no=100, registration_id="100_1", transplant_organ="Kidney"
+    )
+    audit_rows = utils.create_audit_rows(df_columns)
+    audit_rows["new_transplants"].append(
+        utils.make_transplant_match_row("New", transplant, None)
+    )
+
+    history.append_history(
+        history_file_path,
+        utils.create_output_dfs(df_columns, audit_rows),
+        "january.csv",
+    )
+
+    records = history.query_history(history_file_path, registration_id="100_1")
+    assert records["Sheet"].tolist() == ["new_transplants"]
+    assert records["Registration ID - NHSBT"].tolist() == ["100_1"]
+    assert records["Transplant Organ - NHSBT"].tolist() == ["Kidney"]
@@ -4,11 +4,10 @@ import sys
 import datetime
 from io import StringIO
 
-import nhs_number
 import pandas as pd
 import pytest
 from faker import Faker
-from sqlalchemy import Engine, create_engine
+from sqlalchemy import Engine, create_engine, text
 from sqlalchemy.orm import Session, sessionmaker
 from ukrr_models import nhsbt_models, rr_models  # type: ignore
 
@@ -48,22 +47,6 @@ def nhsbt_session():
     session.close()
 
 
-@pytest.fixture()
-def rr_session():
-    engine = create_engine("sqlite:///:memory:")
-    rr_models.Base.metadata.create_all(bind=engine)
-
-    # Create a new session for each test
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    yield session
-
-    # Rollback the transaction to clean up after the test
-    session.rollback()
-    session.close()
-
-
 @pytest.fixture
 def df_columns():
     columns = {
@@ -77,11 +60,6 @@ def df_columns():
     return columns
 
 
-@pytest.fixture
-def df_data():
-    return {"Name": fake.name(), "Age": fake.random_int(min=18, max=99)}
-
-
 @pytest.fixture
 def uktssa_data():
     return pd.Series([fake.unique.random_number(digits=6) for _ in range(10)])
@@ -172,21 +150,31 @@ def existing_transplant():
     )
 
 
-def test_add_df_row(df_data):
-    df = pd.DataFrame({"Name": ["Alice", "Bob"], "Age": [25, 30]})
-    expected_df = pd.DataFrame(
-        {"Name": ["Alice", "Bob", df_data["Name"]], "Age": [25, 30, df_data["Age"]]}
-    )
-    result_df = utils.add_df_row(df, df_data)
-    assert expected_df.equals(result_df)
-
-
 def test_args_parse(mocker):
     mock_arg = ["-d", fake.file_path(depth=1)]
     mocker.patch("os.path.exists", return_value=True)
     mocker.patch("os.path.isdir", return_value=True)
     args = utils.args_parse(mock_arg)
     assert args.directory == mock_arg[1]
+    assert args.batch_size == 1000
+
+    assert utils.args_parse(mock_arg + ["--batch-size", "50"]).batch_size == 50
+    assert utils.args_parse(mock_arg + ["--query-workers", "4"]).query_workers == 4
+    assert args.audit_format == ["xlsx"]
+    assert (
+        utils.args_parse(mock_arg + ["--history-file", "history.sqlite"]).history_file
+        == "history.sqlite"
+    )
+    assert utils.args_parse(
+        mock_arg + ["--audit-format", "xlsx", "sqlite"]
+    ).audit_format == ["xlsx", "sqlite"]
+    with pytest.raises(SystemExit):
+        utils.args_parse(mock_arg + ["--audit-format", "json"])
+    mocker.patch("importlib.util.find_spec", return_value=None)
+    with pytest.raises(SystemExit):
+        utils.args_parse(mock_arg + ["--audit-format", "parquet"])
+    with pytest.raises(SystemExit):
+        utils.args_parse(mock_arg + ["--batch-size", "0"])
 
     captured = StringIO()
     sys.stderr = captured
@@ -203,6 +191,95 @@ def test_args_parse(mocker):
         utils.args_parse(mock_arg)
 
 
+def _add_patient(session: Session, uktssa_no: int):
+    session.add(
+        nhsbt_models.UKTPatient(
+            uktssa_no=uktssa_no,
+            surname="TestSurname",
+            forename="TestForename",
+            sex="M",
+            post_code="AB12CD",
+            new_nhs_no=1234567890,
+            chi_no=9876543210,
+            hsc_no=1111111111,
+            rr_no=2222222222,
+            ukt_date_death=datetime.datetime(2020, 1, 1),
+            ukt_date_birth=datetime.datetime(1980, 1, 1),
+        )
+    )
+
+
+def _add_transplant(session: Session, registration_id: str):
+    session.add(
+        nhsbt_models.UKTTransplant(
+            registration_id=registration_id,
+            uktssa_no=int(registration_id.split("_")[0]),
+            transplant_id=2000,
+            transplant_type="TypeA",
+            transplant_organ="Kidney",
+            transplant_unit="UnitX",
+            rr_no=3000,
+            transplant_date=datetime.datetime(2020, 1, 1),
+            ukt_fail_date=datetime.datetime(2021, 1, 1),
+            registration_date=datetime.datetime(2019, 1, 1),
+            registration_date_type="Original",
+            registration_end_date=datetime.datetime(2022, 1, 1),
+            registration_end_status="Completed",
+            transplant_consideration="Standard",
+            transplant_dialysis="Yes",
+            transplant_relationship="None",
+            transplant_sex="M",
+            cause_of_failure="A01",
+            cause_of_failure_text="Rejection",
+            cit_mins="120",
+            hla_mismatch="2",
+            ukt_suspension=False,
+        )
+    )
+
+
+def test_batch_query(nhsbt_session: Session):
+    for uktssa_no in range(1, 11):
+        _add_patient(nhsbt_session, uktssa_no)
+    nhsbt_session.commit()
+
+    results = utils.batch_query(
+        [2, 4, 6, 8, 99],
+        nhsbt_session,
+        nhsbt_models.UKTPatient,
+        nhsbt_models.UKTPatient.uktssa_no,
+        batch_size=2,
+    )
+
+    assert sorted(patient.uktssa_no for patient in results) == [2, 4, 6, 8]
+
+
+def test_batch_query_workers(tmp_path, mocker):
+    session_factory = utils.create_session_factory(f"sqlite:///{tmp_path / 'nhsbt.db'}")
+    with session_factory() as session:
+        nhsbt_models.Base.metadata.create_all(bind=session.get_bind())
+        for uktssa_no in range(1, 11):
+            _add_patient(session, uktssa_no)
+        session.commit()
+        query = mocker.spy(session, "query")
+        factory = mocker.Mock(wraps=session_factory)
+
+        results = utils.batch_query(
+            [1, 9, 2, 99, 5, 7, 4],
+            session,
+            nhsbt_models.UKTPatient,
+            nhsbt_models.UKTPatient.uktssa_no,
+            batch_size=2,
+            workers=3,
+            session_factory=factory,
+        )
+
+    # The batches are queried by the workers' own sessions and merged in order
+    query.assert_not_called()
+    assert factory.call_count == 4
+    assert [patient.uktssa_no for patient in results] == [1, 9, 2, 5, 7, 4]
+
+
 def test_check_missing_patients(nhsbt_session: Session):
     db_data = [12345, 67890, 54321]
     file_data = [12345, 67890, 99999]
@@ -269,20 +346,83 @@ def test_check_missing_transplants(nhsbt_session: Session):
     assert missing_transplants == ["100_3"]
 
 
-def test_compare_patients(incoming_patient, existing_patient):
-    result = utils.compare_patients(incoming_patient, incoming_patient)
-    assert result is True
+def test_clean_csv(tmp_path):
+    raw = (
+        "UKTR_ID,Name\n1,Caf\u00e9\x00 \u2013 Jo\n2,Ren\u00e9e\n".encode()
+        + b"3,\xffBad\n"
+    )
+    input_file = tmp_path / "nhsbt.csv"
+    input_file.write_bytes(raw)
+
+    with utils.clean_csv(str(input_file)) as cleaned:
+        assert cleaned.read() == b"UKTR_ID,Name\n1,Caf  Jo\n2,Rene\n3,Bad\n"
+
+    assert input_file.read_bytes() == raw
+
+
+def test_clean_csv_read_csv(tmp_path):
+    input_file = tmp_path / "nhsbt.csv"
+    input_file.write_bytes(b"UKTR_ID,Name\n" + b"\xe2\x80\x93" * 5000 + b"1,Jo\x00e\n")
 
-    result = utils.compare_patients(incoming_patient, existing_patient)
-    assert result is False
+    with utils.clean_csv(str(input_file)) as cleaned:
+        nhsbt_df = pd.read_csv(cleaned, na_filter=False)
 
+    assert nhsbt_df.to_dict("records") == [{"UKTR_ID": 1, "Name": "Joe"}]
 
-def test_compare_transplants(incoming_transplant, existing_transplant):
-    result = utils.compare_transplants(incoming_transplant, incoming_transplant)
-    assert result is True
 
-    result = utils.compare_transplants(incoming_transplant, existing_transplant)
-    assert result is False
+def test_find_patient_changes(existing_patient):
+    incoming_patient = nhsbt_models.UKTPatient(
+        **{field: getattr(existing_patient, field) for field in utils.PATIENT_FIELDS}
+    )
+    incoming_patient.post_code = "AB1 2CD"
+
+    # post_code alone isn't enough to update a patient
+    assert utils.find_patient_changes(incoming_patient, existing_patient) == 0
+
+    incoming_patient.surname = "CHANGED"
+    incoming_patient.ukt_date_birth = datetime.datetime(1970, 1, 1)
+    changes = utils.find_patient_changes(incoming_patient, existing_patient)
+
+    assert changes == utils.field_mask(
+        utils.PATIENT_FIELDS, ["surname", "post_code", "ukt_date_birth"]
+    )
+    assert utils.changed_fields(changes, utils.PATIENT_FIELDS) == [
+        "surname",
+        "post_code",
+        "ukt_date_birth",
+    ]
+    assert utils.changed_labels(changes, utils.PATIENT_FIELDS) == [
+        "Surname",
+        "Postcode",
+        "Date Birth",
+    ]
+
+
+def test_find_transplant_changes(existing_transplant):
+    incoming_transplant = nhsbt_models.UKTTransplant(
+        **{
+            field: getattr(existing_transplant, field)
+            for field in utils.TRANSPLANT_FIELDS
+        }
+    )
+    assert utils.find_transplant_changes(incoming_transplant, existing_transplant) == 0
+
+    incoming_transplant.ukt_fail_date = datetime.datetime(2020, 1, 1)
+    incoming_transplant.hla_mismatch = "0 0 0"
+    changes = utils.find_transplant_changes(incoming_transplant, existing_transplant)
+
+    assert utils.changed_fields(changes, utils.TRANSPLANT_FIELDS) == [
+        "ukt_fail_date",
+        "hla_mismatch",
+    ]
+    # The fail date has no column in the audit file
+    assert utils.changed_labels(changes, utils.TRANSPLANT_FIELDS) == ["HLA Mismatch"]
+
+
+def test_create_audit_rows(df_columns):
+    audit_rows = utils.create_audit_rows(df_columns)
+
+    assert audit_rows == {sheet: [] for sheet in df_columns}
 
 
 def test_create_df():
@@ -296,33 +436,32 @@ def test_create_df():
     assert df.empty
 
 
-gen_nhs_no = int(nhs_number.generate(for_region=nhs_number.REGION_ENGLAND)[0])
-gen_chi_no = int(nhs_number.generate(for_region=nhs_number.REGION_SCOTLAND)[0])
-gen_hsc_no = int(nhs_number.generate(for_region=nhs_number.REGION_NORTHERN_IRELAND)[0])
+nhs_no, chi_no, hsc_no = 4000000011, 1234567890, 3200000001
 
 
 @pytest.mark.parametrize(
-    "nhs_no, chi_no, hsc_no",
+    "numbers, expected",
     [
-        (None, gen_chi_no, gen_chi_no),
-        (gen_nhs_no, None, None),
-        (gen_chi_no, None, None),
-        (gen_hsc_no, None, None),
-        (None, gen_chi_no, None),
-        (None, gen_nhs_no, None),
-        (None, gen_hsc_no, None),
-        (None, None, gen_hsc_no),
-        (None, None, gen_nhs_no),
-        (None, None, gen_chi_no),
-        (gen_nhs_no, gen_chi_no, None),
-        (gen_chi_no, gen_nhs_no, None),
-        (gen_nhs_no, None, gen_hsc_no),
-        (gen_hsc_no, None, gen_nhs_no),
-        (None, gen_chi_no, gen_hsc_no),
-        (None, gen_hsc_no, gen_chi_no),
-        (gen_nhs_no, gen_chi_no, gen_hsc_no),
-        (gen_chi_no, gen_nhs_no, gen_hsc_no),
-        (gen_hsc_no, gen_chi_no, gen_nhs_no),
+        ((None, chi_no, chi_no), (None, chi_no, None)),
+        ((nhs_no, None, None), (nhs_no, None, None)),
+        ((chi_no, None, None), (None, chi_no, None)),
+        ((hsc_no, None, None), (None, None, hsc_no)),
+        ((None, chi_no, None), (None, chi_no, None)),
+        ((None, nhs_no, None), (nhs_no, None, None)),
+        ((None, hsc_no, None), (None, None, hsc_no)),
+        ((None, None, hsc_no), (None, None, hsc_no)),
+        ((None, None, nhs_no), (nhs_no, None, None)),
+        ((None, None, chi_no), (None, chi_no, None)),
+        ((nhs_no, chi_no, None), (nhs_no, chi_no, None)),
+        ((chi_no, nhs_no, None), (nhs_no, chi_no, None)),
+        ((nhs_no, None, hsc_no), (nhs_no, None, hsc_no)),
+        ((hsc_no, None, nhs_no), (nhs_no, None, hsc_no)),
+        ((None, chi_no, hsc_no), (None, chi_no, hsc_no)),
+        ((None, hsc_no, chi_no), (None, chi_no, hsc_no)),
+        ((nhs_no, chi_no, hsc_no), (nhs_no, chi_no, hsc_no)),
+        # A row with any number moved keeps only the numbers that were moved
+        ((chi_no, nhs_no, hsc_no), (nhs_no, chi_no, None)),
+        ((hsc_no, chi_no, nhs_no), (nhs_no, None, hsc_no)),
     ],
     ids=[
         "multiple",
@@ -346,119 +485,27 @@ gen_hsc_no = int(nhs_number.generate(for_region=nhs_number.REGION_NORTHERN_IRELA
         "test_all_swapped_2",
     ],
 )
-def test_create_incoming_patient_valid_input(nhs_no, chi_no, hsc_no):
-    fake_date = fake.date()
-    row = {
-        "UKTR_ID": fake.random_int(),
-        "UKTR_RSURNAME": fake.last_name(),
-        "UKTR_RFORENAME": fake.first_name(),
-        "UKTR_RSEX": fake.random_element(elements=("1", "2")),
-        "UKTR_RPOSTCODE": fake.pystr_format(string_format="??## #??").upper(),
-        "UKTR_RNHS_NO": nhs_no,
-        "UKTR_RCHI_NO_NI": hsc_no,
-        "UKTR_RCHI_NO_SCOT": chi_no,
-        "UKTR_DDATE": fake_date,
-        "UKTR_RDOB": fake_date,
-    }
-
-    index = fake.random_int(min=1, max=99999)
-    patient = utils.create_incoming_patient(index, row)
-
-    assert isinstance(patient.uktssa_no, (int, type(None)))
-    assert isinstance(patient.surname, (str, type(None)))
-    assert isinstance(patient.forename, (str, type(None)))
-    assert patient.sex in ("0", "1", "2", "9")
-    assert isinstance(patient.post_code, (str, type(None)))
-    assert isinstance(patient.new_nhs_no, (int, type(None)))
-    assert isinstance(patient.chi_no, (int, type(None)))
-    assert patient.hsc_no == row["UKTR_RCHI_NO_NI"]
-    assert patient.rr_no is None
-    assert isinstance(patient.ukt_date_death, (datetime.date, type(None)))
-    assert isinstance(patient.ukt_date_birth, (datetime.date, type(None)))
-
-    if patient.hsc_no:
-        assert patient.hsc_no == int(gen_hsc_no)
-    if patient.new_nhs_no:
-        assert patient.new_nhs_no == int(gen_nhs_no)
-    if patient.chi_no:
-        assert patient.chi_no == int(gen_chi_no)
-
-
-def test_create_incoming_patient_invalid_uktr_id():
-    row = {
-        "UKTR_ID": fake.pystr(),
-        "UKTR_RSURNAME": fake.last_name(),
-        "UKTR_RFORENAME": fake.first_name(),
-        "UKTR_RSEX": fake.random_element(elements=("M", "F")),
-        "UKTR_RPOSTCODE": fake.postcode(),
-        "UKTR_RNHS_NO": fake.random_number(digits=10),
-        "UKTR_RCHI_NO_NI": fake.random_number(digits=8),
-        "UKTR_RCHI_NO_SCOT": fake.random_number(digits=10),
-        "UKTR_DDATE": fake.date,
-        "UKTR_RDOB": fake.date,
-    }
-    index = fake.random_int(min=1, max=6)
-
-    with pytest.raises(ValueError) as e:
-        utils.create_incoming_patient(index, row)
-    assert str(e.value) == f"UKTR_ID must be a valid number, check row {index + 1}"
-
-
-def test_create_incoming_transplant():
-    # This test fails sometimes, I suspect it's to do with the changes
-    # to boolean for the uktr_suspension I saw in a previous commit
-    row = pd.Series(
+def test_parse_patients_numbers(numbers, expected):
+    nhs, chi, hsc = numbers
+    nhsbt_df = pd.DataFrame(
         {
-            "uktr_tx_id1": fake.random_number(digits=4),
-            "uktr_txdate1": fake.date(),
-            "uktr_dgrp1": fake.word(),
-            "uktr_tx_type1": fake.word(),
-            "uktr_tx_unit1": fake.company(),
-            "uktr_faildate1": None,
-            "UKTR_ID": fake.random_number(digits=4),
-            "uktr_date_on1": fake.date(),
-            "uktr_list_status1": fake.word(),
-            "uktr_removal_date1": None,
-            "uktr_endstat1": None,
-            "uktr_tx_list1": fake.word(),
-            "uktr_dial_at_tx1": fake.word(),
-            "uktr_relationship1": fake.word(),
-            "uktr_dsex1": fake.random_element(elements=("M", "F", None)),
-            "uktr_cof1": fake.word(),
-            "uktr_other_cof_text1": None,
-            "uktr_cit_mins1": str(fake.random_number(digits=2)),
-            "uktr_hla_mm1": str(fake.random_number(digits=1)),
-            "uktr_suspension_1": fake.random_element(elements=("1", "0", None)),
-        }
+            "UKTR_ID": [101],
+            "UKTR_RSURNAME": ["Smith"],
+            "UKTR_RFORENAME": ["Jo"],
+            "UKTR_RSEX": ["1"],
+            "UKTR_RPOSTCODE": ["AB12 3CD"],
+            "UKTR_RNHS_NO": [nhs],
+            "UKTR_RCHI_NO_NI": [hsc],
+            "UKTR_RCHI_NO_SCOT": [chi],
+            "UKTR_DDATE": [""],
+            "UKTR_RDOB": ["1970-01-02"],
+        },
+        dtype=object,
     )
-    transplant_counter = 1
-    index = 1
-
-    result = utils.create_incoming_transplant(index, row, transplant_counter)
-
-    assert isinstance(result, nhsbt_models.UKTTransplant)
-    assert isinstance(result.registration_id, (str, type(None)))
-    assert isinstance(result.uktssa_no, (int, type(None)))
-    assert isinstance(result.transplant_id, (int, type(None)))
-    assert isinstance(result.transplant_type, (str, type(None)))
-    assert isinstance(result.transplant_organ, (str, type(None)))
-    assert isinstance(result.transplant_unit, (str, type(None)))
-    assert isinstance(result.rr_no, (int, type(None)))
-    assert isinstance(result.transplant_date, (datetime.datetime, type(None)))
-    assert isinstance(result.ukt_fail_date, (datetime.datetime, type(None)))
-    assert isinstance(result.registration_date, (datetime.datetime, type(None)))
-    assert isinstance(result.registration_date_type, (str, type(None)))
-    assert isinstance(result.registration_end_date, (datetime.datetime, type(None)))
-    assert isinstance(result.registration_end_status, (str, type(None)))
-    assert isinstance(result.transplant_consideration, (str, type(None)))
-    assert isinstance(result.transplant_dialysis, (str, type(None)))
-    assert isinstance(result.transplant_relationship, (str, type(None)))
-    assert result.transplant_sex in ("0", "1", "2", "9", None)
-    assert isinstance(result.cause_of_failure, (str, type(None)))
-    assert isinstance(result.cause_of_failure_text, (str, type(None)))
-    assert isinstance(result.cit_mins, (str, type(None)))
-    assert isinstance(result.hla_mismatch, (str, type(None)))
-    assert result.ukt_suspension in (True, False, None)
+
+    patient = utils.parse_patients(nhsbt_df).iloc[0]
+
+    assert (patient.new_nhs_no, patient.chi_no, patient.hsc_no) == expected
 
 
 def test_create_logs(mocker):
@@ -496,6 +543,75 @@ def test_create_output_dfs(df_columns):
             assert output_dfs[sheet]["UKT Suspension - RR"].dtype == bool
 
 
+def test_create_output_dfs_with_audit_rows(df_columns):
+    audit_rows = utils.create_audit_rows(df_columns)
+    new_columns = df_columns["new_transplants"]
+    for suspension in (True, False, None):
+        audit_rows["new_transplants"].append(
+            {
+                new_columns[0]: fake.word(),
+                "UKT Suspension - NHSBT": suspension,
+                utils.CHANGED_COLUMNS: [],
+            }
+        )
+
+    output_dfs = utils.create_output_dfs(df_columns, audit_rows)
+
+    assert output_dfs["new_transplants"].shape == (3, len(new_columns))
+    assert list(output_dfs["new_transplants"].columns) == new_columns
+    assert output_dfs["new_transplants"]["UKT Suspension - NHSBT"].tolist() == [
+        True,
+        False,
+        None,
+    ]
+    assert output_dfs["other_sheet"].empty
+
+
+def test_create_patient_index(nhsbt_session: Session):
+    for uktssa_no in (12345, 67890, 54321):
+        _add_patient(nhsbt_session, uktssa_no)
+    nhsbt_session.commit()
+
+    patient_index = utils.create_patient_index(nhsbt_session, [12345, 67890, 99999])
+
+    assert set(patient_index) == {12345, 67890}
+    assert [patient.uktssa_no for patient in patient_index[12345]] == [12345]
+    assert patient_index.get(99999, []) == []
+
+
+def test_create_patient_index_deleted(nhsbt_session: Session):
+    rr_models.Base.metadata.create_all(bind=nhsbt_session.get_bind())
+    for uktssa_no in (12345, 67890):
+        _add_patient(nhsbt_session, uktssa_no)
+    for rr_no, uktssa_no in ((1000, 67890), (1001, 54321), (1002, 11111)):
+        nhsbt_session.add(
+            rr_models.UKRR_Deleted_Patient(
+                rr_no=rr_no,
+                surname="Surname",
+                forename="Forename",
+                sex="M",
+                nhs_no=9000000000,
+                chi_no=8000000000,
+                hsc_no=7000000000,
+                uk_tssa_no=uktssa_no,
+                local_hosp_no="HOSP",
+                date_birth=datetime.date(1980, 1, 1),
+                date_death=datetime.date(2020, 1, 1),
+            )
+        )
+    nhsbt_session.commit()
+    deleted_index: dict = {}
+
+    patient_index = utils.create_patient_index(
+        nhsbt_session, [12345, 67890, 54321, 99999], deleted_index
+    )
+
+    assert set(patient_index) == {12345, 67890}
+    assert [patient.uktssa_no for patient in patient_index[67890]] == [67890]
+    assert set(deleted_index) == {67890, 54321}
+    assert [patient.rr_no for patient in deleted_index[54321]] == [1001]
+
+
 def test_create_session():
     session = utils.create_session()
 
@@ -506,36 +622,43 @@ def test_create_session():
     assert session.bind.url.database == "renalreg"
 
 
-def test_deleted_patient_check(rr_session):
-    mock_results = [(1,), (3,), (5,)]
-    for idx, (uk_tssa_no,) in enumerate(mock_results):
-        rr_session.add(
-            rr_models.UKRR_Deleted_Patient(
-                rr_no=1000 + idx,
-                surname=f"Surname{idx}",
-                forename=f"Forename{idx}",
-                sex="M",
-                nhs_no=9000000000 + idx,
-                chi_no=8000000000 + idx,
-                hsc_no=7000000000 + idx,
-                uk_tssa_no=uk_tssa_no,
-                local_hosp_no=f"HOSP{idx}",
-                date_birth=datetime.date(1980 + idx, 1, 1),
-                date_death=datetime.date(2020 + idx, 1, 1),
-            )
-        )
-    rr_session.commit()
+def test_create_session_factory(tmp_path):
+    database_url = f"sqlite:///{tmp_path / 'nhsbt.db'}"
+    session_factory = utils.create_session_factory(
+        database_url,
+        pool_size=2,
+        isolation_level="SERIALIZABLE",
+        statement_timeout=7,
+    )
 
-    file_patients = [1, 2, 3, 4, 5]
+    with session_factory() as session:
+        assert session.autoflush is False
+        assert str(session.bind.url) == database_url
+        assert session.bind.pool.size() == 2
+        assert session.connection().get_isolation_level() == "SERIALIZABLE"
+        assert session.execute(text("PRAGMA busy_timeout")).scalar() == 7000
 
-    deleted_patients = utils.deleted_patient_check(rr_session, file_patients)
 
-    # Check the results
-    assert set(deleted_patients) == {1, 3, 5}
+def test_create_session_factory_environment(tmp_path, monkeypatch):
+    database_url = f"sqlite:///{tmp_path / 'nhsbt.db'}"
+    monkeypatch.setenv("NHSBT_IMPORT_DATABASE_URL", database_url)
 
-    # # Ensure that the session's query method was called
-    # session.query.assert_called_once_with(UKRR_Deleted_Patient.uktssa_no)
-    # session.query.return_value.all.assert_called_once_with()
+    session_factory = utils.create_session_factory()
+
+    assert str(session_factory.kw["bind"].url) == database_url
+
+
+def test_create_transplant_index(nhsbt_session: Session):
+    for registration_id in ("100_1", "100_2", "200_1"):
+        _add_transplant(nhsbt_session, registration_id)
+    nhsbt_session.commit()
+
+    transplant_index = utils.create_transplant_index(
+        nhsbt_session, ["100_1", "200_1", "300_1"]
+    )
+
+    assert set(transplant_index) == {"100_1", "200_1"}
+    assert transplant_index["200_1"][0].uktssa_no == 200
 
 
 def test_format_bool():
@@ -558,6 +681,16 @@ def test_format_bool():
         assert result is None
 
 
+def test_format_bool_column():
+    values = pd.Series(
+        ["1", "1.0", 1, 1.0, "True", True, "0", 0.0, "false", False, "2", "", None, 42]
+    )
+
+    result = utils.format_bool_column(values)
+
+    assert result.tolist() == [utils.format_bool(value) for value in values]
+
+
 def test_format_date():
     result_date_year_first = utils.format_date("2023-11-22")
     assert result_date_year_first == datetime.datetime.strptime(
@@ -610,6 +743,38 @@ def test_format_date():
     assert result_date_in_date_out == datetime.date(1995, 5, 7)
 
 
+def test_format_date_column():
+    values = pd.Series(["2023-11-22", "15-06-1995", "", None, "invalid_date"])
+
+    result = utils.format_date_column(values)
+
+    assert result.tolist() == [utils.format_date(value) for value in values]
+    assert result.dtype == object
+
+
+def test_format_date_column_inferred_format(caplog):
+    values = pd.Series(
+        [
+            "04/06/1995",
+            "05/13/2020",
+            "31/02/2020",
+            "",
+            "2022/03/15",
+            "01/01/1600",
+            "13/01/2020 10:30",
+        ],
+        index=[3, 3, 4, 5, 6, 7, 8],
+    )
+
+    with caplog.at_level(logging.WARNING):
+        result = utils.format_date_column(values)
+
+    assert result.index.tolist() == values.index.tolist()
+    assert result.tolist() == [utils.format_date(value) for value in values]
+    assert all(type(date) is datetime.datetime for date in result.dropna())
+    assert caplog.messages == ["31/02/2020 is not a valid date"] * 2
+
+
 def test_format_int():
     valid_values = [42, "42", 3.14, "1000", "0", "123"]
 
@@ -627,6 +792,28 @@ def test_format_int():
     assert result_invalid_value is None
 
 
+def test_format_int_column():
+    values = pd.Series([42, "42", 3.14, " 7 ", "+5", "1.5", "", None, "abc", pd.NA])
+
+    result = utils.format_int_column(values)
+
+    assert result.tolist() == [utils.format_int(value) for value in values]
+    assert all(isinstance(value, (int, type(None))) for value in result)
+
+    numeric = pd.Series([4000000000, 1, 0])
+    assert utils.format_int_column(numeric).tolist() == [4000000000, 1, 0]
+
+
+def test_format_sex_column():
+    values = pd.Series(["1", "2", "M", "female", "NK", "ns", "9.0", "", None, "x"])
+
+    result = utils.format_sex_column(values, values.index)
+
+    assert result.tolist() == [
+        utils.format_sex(value, index) for index, value in values.items()
+    ]
+
+
 def test_format_str():
     valid_values = ["Hello", 42, 3.14, "123", pd.NA, {"key": "value"}]
 
@@ -640,6 +827,14 @@ def test_format_str():
     assert utils.format_str(None) is None
 
 
+def test_format_str_column():
+    values = pd.Series(["Hello", 42, 3.14, "", None, pd.NA])
+
+    result = utils.format_str_column(values)
+
+    assert result.tolist() == [utils.format_str(value) for value in values]
+
+
 def test_format_postcode():
     result = utils.format_postcode(123)
     assert result == "123"
@@ -681,6 +876,16 @@ def test_format_postcode():
     assert result_invalid_short == "ABC"
 
 
+def test_format_postcode_column():
+    values = pd.Series(
+        ["ab123cd", "ab 12 3 cd", "AB12  3CD", "b", "", " ", "ab13cd", 123, None]
+    )
+
+    result = utils.format_postcode_column(values, values.index)
+
+    assert result.tolist() == [utils.format_postcode(value) for value in values]
+
+
 def test_get_input_file_path_single_csv(mocker):
     with mocker.patch("os.listdir", return_value=["file.csv"]):
         directory = "/path/to/directory"
@@ -747,6 +952,7 @@ def test_make_transplant_match_row(incoming_transplant, existing_transplant):
     assert row.get("Match Type") == match_type
     assert row.get("UKTSSA_No") == incoming_transplant.uktssa_no
     assert row.get("Transplant ID - NHSBT") == incoming_transplant.transplant_id
+    assert "Registration ID - NHSBT" not in row
     assert isinstance(row.get("Transplant Date - NHSBT"), (datetime.date, type(None)))
     assert row.get("Transplant Type - NHSBT") == incoming_transplant.transplant_type
     assert row.get("Transplant Organ - NHSBT") == incoming_transplant.transplant_organ
@@ -776,6 +982,379 @@ def test_make_transplant_match_row(incoming_transplant, existing_transplant):
         == incoming_transplant.transplant_relationship
     )
 
+    row = utils.make_transplant_match_row(match_type, incoming_transplant, None)
+    assert row["Registration ID - NHSBT"] == incoming_transplant.registration_id
+
+
+def test_normalise_patient(existing_patient):
+    incoming_patient = nhsbt_models.UKTPatient(
+        **{field: getattr(existing_patient, field) for field in utils.PATIENT_FIELDS}
+    )
+    incoming_patient.surname = f" {existing_patient.surname} "
+    incoming_patient.new_nhs_no = float(existing_patient.new_nhs_no)
+    incoming_patient.chi_no = ""
+    existing_patient.ukt_date_birth = datetime.datetime(1980, 5, 6)
+    incoming_patient.ukt_date_birth = datetime.date(1980, 5, 6)
+
+    assert utils.normalise_patient(incoming_patient) == utils.normalise_patient(
+        existing_patient
+    )
+    assert utils.find_patient_changes(incoming_patient, existing_patient) == 0
+
+
+def test_normalise_transplant():
+    incoming_transplant = nhsbt_models.UKTTransplant(
+        transplant_date=datetime.datetime(2020, 1, 2),
+        ukt_fail_date=None,
+        cause_of_failure="12",
+        cit_mins="720",
+        hla_mismatch="000",
+        ukt_suspension=False,
+    )
+    existing_transplant = nhsbt_models.UKTTransplant(
+        transplant_date=datetime.date(2020, 1, 2),
+        ukt_fail_date=pd.NaT,
+        cause_of_failure=12,
+        cit_mins=720.0,
+        hla_mismatch="000",
+        ukt_suspension=0,
+    )
+
+    incoming = utils.normalise_transplant(incoming_transplant)
+    assert incoming == utils.normalise_transplant(existing_transplant)
+    fields = list(utils.TRANSPLANT_FIELDS)
+    assert incoming[fields.index("transplant_date")] == datetime.datetime(2020, 1, 2)
+    assert incoming[fields.index("cit_mins")] == "720"
+    # Text isn't treated as a number
+    assert incoming[fields.index("hla_mismatch")] == "000"
+
+    existing_transplant.hla_mismatch = "0"
+    changes = utils.find_transplant_changes(incoming_transplant, existing_transplant)
+    assert utils.changed_fields(changes, utils.TRANSPLANT_FIELDS) == ["hla_mismatch"]
+
+
+def test_parse_patients():
+    nhsbt_df = pd.DataFrame(
+        {
+            "UKTR_ID": [101, 102],
+            "UKTR_RSURNAME": ["Smith", "Jones"],
+            "UKTR_RFORENAME": ["Jo", ""],
+            "UKTR_RSEX": ["1", "F"],
+            "UKTR_RPOSTCODE": ["ab123cd", ""],
+            "UKTR_RNHS_NO": [nhs_no, ""],
+            "UKTR_RCHI_NO_NI": ["", hsc_no],
+            "UKTR_RCHI_NO_SCOT": ["", ""],
+            "UKTR_DDATE": ["", "2020-01-01"],
+            "UKTR_RDOB": ["01/02/1970", "1980-03-04"],
+        }
+    )
+
+    patients = utils.parse_patients(nhsbt_df)
+
+    assert patients.index.tolist() == [1, 2]
+    assert patients.to_dict("records") == [
+        {
+            "uktssa_no": 101,
+            "surname": "Smith",
+            "forename": "Jo",
+            "sex": "1",
+            "post_code": "AB12 3CD",
+            "new_nhs_no": nhs_no,
+            "chi_no": None,
+            "hsc_no": None,
+            "rr_no": None,
+            "ukt_date_death": None,
+            "ukt_date_birth": datetime.datetime(1970, 2, 1),
+        },
+        {
+            "uktssa_no": 102,
+            "surname": "Jones",
+            "forename": "",
+            "sex": "2",
+            "post_code": "",
+            "new_nhs_no": None,
+            "chi_no": None,
+            "hsc_no": hsc_no,
+            "rr_no": None,
+            "ukt_date_death": datetime.datetime(2020, 1, 1),
+            "ukt_date_birth": datetime.datetime(1980, 3, 4),
+        },
+    ]
+
+
+def test_parse_patients_invalid_uktr_id():
+    nhsbt_df = pd.DataFrame(
+        {
+            "UKTR_ID": [101, 0],
+            "UKTR_RSURNAME": ["", ""],
+            "UKTR_RFORENAME": ["", ""],
+            "UKTR_RSEX": ["1", "2"],
+            "UKTR_RPOSTCODE": ["", ""],
+            "UKTR_RNHS_NO": [nhs_no, nhs_no],
+            "UKTR_RCHI_NO_NI": ["", ""],
+            "UKTR_RCHI_NO_SCOT": ["", ""],
+            "UKTR_DDATE": ["", ""],
+            "UKTR_RDOB": ["", ""],
+        }
+    )
+
+    with pytest.raises(ValueError) as e:
+        utils.parse_patients(nhsbt_df)
+    assert str(e.value) == "UKTR_ID must be a valid number, check row 3"
+
+
+def test_parse_transplants():
+    slots = {
+        "uktr_tx_id": ["1001", "1002", "", "3001"],
+        "uktr_txdate": ["2020-01-01", "", "", "2021-05-06"],
+        "uktr_dgrp": ["LD", "", "", "DCD"],
+        "uktr_tx_type": ["K", "", "", "KP"],
+        "uktr_tx_unit": ["RFR01", "", "", ""],
+        "uktr_faildate": ["", "", "", "2022-01-01"],
+        "uktr_date_on": ["2019-01-01", "2021-01-01", "2022-01-01", "2020-03-04"],
+        "uktr_list_status": ["A", "S", "", "A"],
+        "uktr_removal_date": ["2020-01-01", "", "", ""],
+        "uktr_endstat": ["TX", "", "", "TX"],
+        "uktr_tx_list": ["1", "", "", "2"],
+        "uktr_dial_at_tx": ["Y", "", "", "N"],
+        "uktr_relationship": ["", "", "", "1"],
+        "uktr_dsex": ["1", "", "", "x"],
+        "uktr_cof": ["12.0", "", "", "abc"],
+        "uktr_other_cof_text": ["", "", "", "Text"],
+        "uktr_cit_mins": ["720", "", "", ""],
+        "uktr_hla_mm": ["1 1 0", "", "", ""],
+        "uktr_suspension_": ["0", "", "", "1"],
+    }
+    # Patient 101 has two transplant slots, 102 has a gap after its first and 103
+    # has none
+    columns: dict[str, list] = {"UKTR_ID": [101, 102, 103]}
+    for column, values in slots.items():
+        columns[f"{column}1"] = [values[0], values[3], ""]
+        columns[f"{column}2"] = [values[1], "", ""]
+        columns[f"{column}3"] = [values[2], values[2], ""]
+    nhsbt_df = pd.DataFrame(columns, index=[5, 6, 7])
+
+    transplants = utils.parse_transplants(nhsbt_df)
+
+    assert transplants["registration_id"].tolist() == [
+        "101_1",
+        "101_2",
+        "101_3",
+        "102_1",
+    ]
+    assert transplants.index.tolist() == [6, 6, 6, 7]
+    records = transplants.to_dict("records")
+    assert records[0] == {
+        "transplant_id": 1001,
+        "uktssa_no": 101,
+        "transplant_date": datetime.datetime(2020, 1, 1),
+        "transplant_type": "LD",
+        "transplant_organ": "K",
+        "transplant_unit": "RFR01",
+        "ukt_fail_date": None,
+        "rr_no": None,
+        "registration_id": "101_1",
+        "registration_date": datetime.datetime(2019, 1, 1),
+        "registration_date_type": "A",
+        "registration_end_date": datetime.datetime(2020, 1, 1),
+        "registration_end_status": "TX",
+        "transplant_consideration": "1",
+        "transplant_dialysis": "Y",
+        "transplant_relationship": "",
+        "transplant_sex": "1",
+        "cause_of_failure": None,
+        "cause_of_failure_text": "",
+        "cit_mins": "720",
+        "hla_mismatch": "1 1 0",
+        "ukt_suspension": False,
+    }
+    # A slot with only a registration keeps blank text and no dates
+    assert records[2] == {
+        "transplant_id": None,
+        "uktssa_no": 101,
+        "transplant_date": None,
+        "transplant_type": "",
+        "transplant_organ": "",
+        "transplant_unit": None,
+        "ukt_fail_date": None,
+        "rr_no": None,
+        "registration_id": "101_3",
+        "registration_date": datetime.datetime(2022, 1, 1),
+        "registration_date_type": "",
+        "registration_end_date": None,
+        "registration_end_status": "",
+        "transplant_consideration": "",
+        "transplant_dialysis": "",
+        "transplant_relationship": "",
+        "transplant_sex": None,
+        "cause_of_failure": None,
+        "cause_of_failure_text": "",
+        "cit_mins": "",
+        "hla_mismatch": "",
+        "ukt_suspension": None,
+    }
+    assert records[1]["transplant_id"] == 1002
+    assert records[1]["registration_date_type"] == "S"
+    assert records[3] == {
+        "transplant_id": 3001,
+        "uktssa_no": 102,
+        "transplant_date": datetime.datetime(2021, 5, 6),
+        "transplant_type": "DCD",
+        "transplant_organ": "KP",
+        "transplant_unit": None,
+        "ukt_fail_date": datetime.datetime(2022, 1, 1),
+        "rr_no": None,
+        "registration_id": "102_1",
+        "registration_date": datetime.datetime(2020, 3, 4),
+        "registration_date_type": "A",
+        "registration_end_date": None,
+        "registration_end_status": "TX",
+        "transplant_consideration": "2",
+        "transplant_dialysis": "N",
+        "transplant_relationship": "1",
+        "transplant_sex": None,
+        "cause_of_failure": None,
+        "cause_of_failure_text": "Text",
+        "cit_mins": "",
+        "hla_mismatch": "",
+        "ukt_suspension": True,
+    }
+
+
+def test_parse_transplants_no_transplants():
+    columns = [
+        "uktr_tx_id",
+        "uktr_txdate",
+        "uktr_dgrp",
+        "uktr_tx_type",
+        "uktr_tx_unit",
+        "uktr_faildate",
+        "uktr_date_on",
+        "uktr_list_status",
+        "uktr_removal_date",
+        "uktr_endstat",
+        "uktr_tx_list",
+        "uktr_dial_at_tx",
+        "uktr_relationship",
+        "uktr_dsex",
+        "uktr_cof",
+        "uktr_other_cof_text",
+        "uktr_cit_mins",
+        "uktr_hla_mm",
+        "uktr_suspension_",
+    ]
+    nhsbt_df = pd.DataFrame({"UKTR_ID": [101], **{f"{c}1": [""] for c in columns}})
+
+    transplants = utils.parse_transplants(nhsbt_df)
+
+    assert transplants.empty
+    assert "registration_id" in transplants.columns
+
+
+def test_read_nhsbt_file(tmp_path):
+    # Large enough for read_csv to infer types a chunk at a time if it were allowed
+    input_file = tmp_path / "nhsbt.csv"
+    input_file.write_text(
+        "UKTR_ID,Name\n" + "".join(f"{i},\n" for i in range(300_000)) + "x,Al\n"
+    )
+
+    nhsbt_df = utils.read_nhsbt_file(str(input_file))
+
+    assert len(nhsbt_df) == 300_001
+    assert nhsbt_df["UKTR_ID"].map(type).eq(str).all()
+
+
+def _nhsbt_csv(uktr_ids: list[int], sex: str) -> str:
+    patient_columns = {
+        "UKTR_ID": uktr_ids,
+        "UKTR_RSURNAME": "Smith",
+        "UKTR_RFORENAME": "Jo",
+        "UKTR_RSEX": sex,
+        "UKTR_RPOSTCODE": "AB12 3CD",
+        "UKTR_RNHS_NO": nhs_no,
+        "UKTR_RCHI_NO_NI": "",
+        "UKTR_RCHI_NO_SCOT": "",
+        "UKTR_DDATE": "",
+        "UKTR_RDOB": "1970-01-02",
+    }
+    slot_columns = [
+        "uktr_tx_id",
+        "uktr_txdate",
+        "uktr_dgrp",
+        "uktr_tx_type",
+        "uktr_tx_unit",
+        "uktr_faildate",
+        "uktr_date_on",
+        "uktr_list_status",
+        "uktr_removal_date",
+        "uktr_endstat",
+        "uktr_tx_list",
+        "uktr_dial_at_tx",
+        "uktr_relationship",
+        "uktr_dsex",
+        "uktr_cof",
+        "uktr_other_cof_text",
+        "uktr_cit_mins",
+        "uktr_hla_mm",
+        "uktr_suspension_",
+    ]
+    slot_values = {"uktr_date_on": "2020-01-01", "uktr_dsex": "1"}
+    nhsbt_df = pd.DataFrame(patient_columns)
+    for column in slot_columns:
+        nhsbt_df[f"{column}1"] = slot_values.get(column, "")
+    return nhsbt_df.to_csv(index=False)
+
+
+def test_parse_nhsbt_file_cache(tmp_path, mocker, caplog):
+    input_file = tmp_path / "nhsbt.csv"
+    input_file.write_text(_nhsbt_csv([101, 102], "x"))
+    cache_directory = tmp_path / "cache"
+    # A cache in the format of an earlier version
+    (cache_directory / "nhsbt_0123").mkdir(parents=True)
+    read_nhsbt_file = mocker.spy(utils, "read_nhsbt_file")
+
+    with caplog.at_level(logging.WARNING):
+        patients, transplants = utils.parse_nhsbt_file(
+            str(input_file), 29, str(cache_directory)
+        )
+    (cache_entry,) = os.listdir(cache_directory)
+    assert cache_entry.startswith(f"nhsbt_v{utils.NHSBT_CACHE_VERSION}_")
+    assert cache_entry.endswith(".pickle")
+    warnings = caplog.messages
+    assert warnings == ["Unrecognised sex at row 2", "Unrecognised sex at row 3"]
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        cached_patients, cached_transplants = utils.parse_nhsbt_file(
+            str(input_file), 29, str(cache_directory)
+        )
+
+    assert read_nhsbt_file.call_count == 1
+    pd.testing.assert_frame_equal(cached_patients, patients)
+    pd.testing.assert_frame_equal(cached_transplants, transplants)
+    assert cached_transplants["registration_id"].tolist() == ["101_1", "102_1"]
+    # The warnings are logged again from the cache
+    assert caplog.messages == warnings
+
+    input_file.write_text(_nhsbt_csv([103], "1"))
+    patients, _ = utils.parse_nhsbt_file(str(input_file), 29, str(cache_directory))
+
+    assert patients["uktssa_no"].tolist() == [103]
+    assert os.listdir(cache_directory) != [cache_entry]
+    assert len(os.listdir(cache_directory)) == 1
+    assert read_nhsbt_file.call_count == 2
+
+
+def test_parse_nhsbt_file_wrong_columns(tmp_path):
+    input_file = tmp_path / "nhsbt.csv"
+    input_file.write_text(_nhsbt_csv([101], "1"))
+    cache_directory = tmp_path / "cache"
+
+    with pytest.raises(ValueError) as e:
+        utils.parse_nhsbt_file(str(input_file), 125, str(cache_directory))
+    assert "Expected 125 columns in the NHSBT file" in str(e.value)
+    assert not cache_directory.exists()
+
 
 def test_update_nhsbt_patient(incoming_patient, existing_patient):
     utils.update_nhsbt_patient(incoming_patient, existing_patient)
@@ -839,3 +1418,98 @@ def test_update_nhsbt_transplant(existing_transplant, incoming_transplant):
     assert existing_transplant.cit_mins == incoming_transplant.cit_mins
     assert existing_transplant.hla_mismatch == incoming_transplant.hla_mismatch
     assert existing_transplant.ukt_suspension == incoming_transplant.ukt_suspension
+
+
+def test_validate_and_correct_number_columns():
+    nhs_no, chi_no, hsc_no = "4000000011", "1234567890", 3200000001
+    numbers = pd.DataFrame(
+        {
+            "UKTR_RNHS_NO": [nhs_no, chi_no, "", "", hsc_no, 0],
+            "UKTR_RCHI_NO_NI": [hsc_no, "", nhs_no, "", "", " 320-000-0005 "],
+            "UKTR_RCHI_NO_SCOT": [chi_no, nhs_no, "", "", "", ""],
+        },
+        index=[5, 6, 7, 8, 9, 10],
+    )
+    row_numbers = numbers.index + 2
+
+    corrected = utils.validate_and_correct_number_columns(numbers, row_numbers)
+
+    # Rows with a number moved keep only the moved numbers, as ints
+    assert corrected.to_dict("index") == {
+        5: {
+            "UKTR_RNHS_NO": nhs_no,
+            "UKTR_RCHI_NO_NI": hsc_no,
+            "UKTR_RCHI_NO_SCOT": chi_no,
+        },
+        6: {
+            "UKTR_RNHS_NO": 4000000011,
+            "UKTR_RCHI_NO_NI": None,
+            "UKTR_RCHI_NO_SCOT": 1234567890,
+        },
+        7: {
+            "UKTR_RNHS_NO": 4000000011,
+            "UKTR_RCHI_NO_NI": None,
+            "UKTR_RCHI_NO_SCOT": None,
+        },
+        8: {"UKTR_RNHS_NO": "", "UKTR_RCHI_NO_NI": "", "UKTR_RCHI_NO_SCOT": ""},
+        9: {"UKTR_RNHS_NO": None, "UKTR_RCHI_NO_NI": hsc_no, "UKTR_RCHI_NO_SCOT": None},
+        10: {
+            "UKTR_RNHS_NO": 0,
+            "UKTR_RCHI_NO_NI": " 320-000-0005 ",
+            "UKTR_RCHI_NO_SCOT": "",
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    "rows, message",
+    [
+        (
+            [["4000000011", "", ""], ["", "9000000000", ""]],
+            "invalid number provided and can not be converted to region, check row 3",
+        ),
+        (
+            [["4000000011", "", ""], ["", "", "400 000 0011"]],
+            "invalid number provided can not be converted to an int: "
+            "'400 000 0011', check row 3",
+        ),
+        (
+            [["", "", "0101234567"], ["", "0101234567", ""]],
+            "invalid number provided must be a valid number, check row 3",
+        ),
+    ],
+    ids=["unknown_region", "unconvertible", "invalid_once_moved"],
+)
+def test_validate_and_correct_number_columns_invalid(rows, message):
+    numbers = pd.DataFrame(
+        rows, columns=["UKTR_RNHS_NO", "UKTR_RCHI_NO_NI", "UKTR_RCHI_NO_SCOT"]
+    )
+
+    with pytest.raises(ValueError) as e:
+        utils.validate_and_correct_number_columns(numbers, numbers.index + 2)
+    assert str(e.value) == message
+
+
+def test_validate_and_correct_number_columns_all_invalid(caplog):
+    numbers = pd.DataFrame(
+        [
+            ["", "9000000000", ""],
+            ["4000000011", "", ""],
+            ["", "", "400-000-0011"],
+            ["", "0101234567", ""],
+        ],
+        columns=["UKTR_RNHS_NO", "UKTR_RCHI_NO_NI", "UKTR_RCHI_NO_SCOT"],
+    )
+    messages = [
+        "invalid number provided and can not be converted to region, check row 2",
+        "invalid number provided can not be converted to an int: '400-000-0011', "
+        "check row 4",
+        "invalid number provided must be a valid number, check row 5",
+    ]
+
+    with caplog.at_level(logging.ERROR):
+        with pytest.raises(ValueError) as e:
+            utils.validate_and_correct_number_columns(numbers, numbers.index + 2)
+
+    assert str(e.value) == "\n".join(messages)
+    assert caplog.messages == messages